@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# timings and peak memory of the pipeline stages for all methods
+# cases: the DDEC and Marina sets of jupyter/ and synthetic halogenated chains and fused ring ladders of growing size
+# every stage runs over all molecules of a case, --repeat times (min and median are kept), peak memory (tracemalloc)
+# comes from one extra run
+#
+#   python benchmarks/run_benchmarks.py --output before.json
+#   python benchmarks/run_benchmarks.py --output after.json
+#   python benchmarks/run_benchmarks.py --compare before.json after.json
+#
+# --check-sweep compares the charges of runSweep (shared preprocessing) with fresh workers for every configuration
+#
+#   python benchmarks/run_benchmarks.py --check-sweep --sets --chain 32 --fused 3 8
+
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tracemalloc
+import numpy as np
+import pandas as pd
+import scipy
+from rdkit import Chem, rdBase
+from rdkit.Chem import AllChem
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from qcalc.workers import createParameters, prepareMolecule, createWorkerFromData
+from qcalc.optimize import createParamsArr, calculateWeights, costFunction
+from qcalc.util.rdkitUtils import extractCharges
+from qcalc.core.BondChargeDistributionMethod import BondChargeDistributionMethod
+from qcalc.sweep import sweepGrid, runSweep
+
+JUPYTER = os.path.join(ROOT, "jupyter")
+METHODS = ["EEM", "QeqAtomic", "QeqBond", "AACT", "SQE"]
+HALOGENS = ["F", "Cl", "Br", "I"]
+STAGES = ["prepare", "createWorker", "coulombIntegrals", "calcBondJMatrix", "precompute", "compute", \
+    "computeWithJacobian", "costFunction"]
+
+
+# parameter setup of the notebooks
+def loadParameters():
+    params = pd.read_csv(os.path.join(JUPYTER, "parameters.dat"), sep=r"\s+")
+    params = params.rename(columns={"#atnm": "atom", "sig": "diameter", "hrd": "hardness", "eln": "electronegativity"})
+    vdw = {"C": 0.17, "Cl": 0.175, "F": 0.147, "Br": 0.185, "I": 0.198}
+    carbons = params["atom"].str.startswith("CH") | params["atom"].str.startswith("CX")
+    params.loc[carbons, "diameter"] = vdw["C"]
+    for hal in HALOGENS:
+        params.loc[params["atom"] == hal, "diameter"] = vdw[hal]
+    params.loc[params["atom"].str.startswith("CH"), "hardness"] = 10.0
+    params.loc[params["atom"].str.startswith("CH"), "electronegativity"] = 6.0
+
+    # bond parameters from the mean atomic parameters of both partners
+    mean = {atom: params.loc[params["atom"].str.startswith(atom)][["hardness", "electronegativity"]].mean() \
+        for atom in ["CH", "CX"] + HALOGENS}
+    rows = []
+    for bond, (a, b) in [("C-C", ("CH", "CX"))] + [("C-" + hal, ("CX", hal)) for hal in HALOGENS]:
+        rows.append({"type": bond, "hardness": 0.5*(mean[a]["hardness"] + mean[b]["hardness"]), \
+            "electronegativity": 0.5*(mean[a]["electronegativity"] + mean[b]["electronegativity"])})
+    return params, pd.DataFrame(rows)
+
+def atomType(atom, mol):
+    symbol = atom.GetSymbol()
+    if symbol in HALOGENS:
+        return symbol
+    elif symbol == "C":
+        n = len([a for a in atom.GetNeighbors() if a.GetSymbol() in HALOGENS])
+        if n > 0:
+            return "CX" + str(n)
+        c = len([a for a in atom.GetNeighbors() if a.GetSymbol() == "C"])
+        return "CH" + str(4 - c)
+
+def bondType(bond, mol):
+    b1 = bond.GetBeginAtom().GetSymbol()
+    b2 = bond.GetEndAtom().GetSymbol()
+    if b1 != "C":
+        b1, b2 = b2, b1
+    return b1 + "-" + b2
+
+
+# molecules without H, target charges with the H charges moved onto the carbons
+def loadSet(name, limit=None):
+    mols, targets = [], []
+    for f in sorted(glob.glob(os.path.join(JUPYTER, name, "HALO_*", "*.sdf")))[:limit]:
+        mol = Chem.MolFromMolFile(f, removeHs=False)
+        if mol is None:
+            continue
+        targets.append(extractCharges(mol))
+        mols.append(Chem.RemoveHs(mol))
+    return mols, targets
+
+# halogenated alkane with n carbons, a substituent on every third carbon
+def chainMolecule(n):
+    smiles = "Br" + "".join("C(" + HALOGENS[(i // 3) % 4] + ")" if i % 3 == 1 else "C" for i in range(n)) + "Cl"
+    mol = Chem.MolFromSmiles(smiles)
+    AllChem.Compute2DCoords(mol)
+    return mol
+
+# ladder of n fused six-membered rings (perhydroacene), B = N + n - 1 bonds: the bond methods see a ring system
+def fusedMolecule(n):
+    mol = Chem.RWMol()
+    top = [mol.AddAtom(Chem.Atom(6)) for _ in range(2*n + 1)]
+    bottom = [mol.AddAtom(Chem.Atom(6)) for _ in range(2*n + 1)]
+    for row in [top, bottom]:
+        for a, b in zip(row[:-1], row[1:]):
+            mol.AddBond(a, b, Chem.BondType.SINGLE)
+    for k in range(0, 2*n + 1, 2):
+        mol.AddBond(top[k], bottom[k], Chem.BondType.SINGLE)
+    mol.AddBond(top[0], mol.AddAtom(Chem.Atom(17)), Chem.BondType.SINGLE)
+    mol.AddBond(bottom[-1], mol.AddAtom(Chem.Atom(35)), Chem.BondType.SINGLE)
+    mol = mol.GetMol()
+    Chem.SanitizeMol(mol)
+    AllChem.Compute2DCoords(mol)
+    return mol
+
+# list of (case name, molecules, target charges)
+def createCases(args):
+    cases = []
+    for name in args.sets:
+        mols, targets = loadSet(name, args.limit)
+        cases.append((name, mols, targets))
+    for n in args.chain:
+        mol = chainMolecule(n)
+        cases.append(("chain" + str(n), [mol], [np.zeros(mol.GetNumAtoms())]))
+    for n in args.fused:
+        mol = fusedMolecule(n)
+        cases.append(("fused" + str(n), [mol], [np.zeros(mol.GetNumAtoms())]))
+    return cases
+
+
+# min and median of repeated runs, peak memory of one more run (bytes above the memory in use at the start)
+def timeStage(func, repeat, memory):
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t)
+    peak = None
+    if memory:
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return dict(min=min(times), median=float(np.median(times)), peakMemory=peak)
+
+def benchmarkCase(name, mols, targets, method, params, bondParamTable, args):
+    bondMethod = method in ["AACT", "SQE"]
+    kwargs = dict(maxOrder=args.max_order, fpepsi=args.fpepsi, kappa=args.kappa, lam=args.lam)
+    prm, bondPrm = createParameters(params, method, bondParamTable=bondParamTable)
+    if not bondMethod:
+        bondPrm = None
+    typing = bondType if bondMethod else None
+
+    molDatas = [prepareMolecule(m, atomType, typing, max(args.max_order, 1)) for m in mols]
+    workers = [createWorkerFromData(d, prm, method, bondParams=bondPrm, **kwargs) for d in molDatas]
+    for worker in workers:
+        worker.precompute()
+    bondWorkers = [w for w in workers if isinstance(w, BondChargeDistributionMethod)]
+
+    # recomputing the geometry caches and starting every solve from a cold factorization
+    def precompute():
+        for worker in workers:
+            worker.invalidateGeometry()
+            worker.precompute()
+
+    def compute(jacobian=False):
+        for worker in workers:
+            worker.factorization = None
+            worker.factorDiagonal = None
+            if jacobian:
+                worker.computeWithJacobian()
+            else:
+                worker.compute()
+
+    # parameters change in every evaluation, as in a fit
+    paramsArr, constr = createParamsArr(prm, bondPrm)
+    weights = calculateWeights([a for w in workers for a in w.atomTypes], prm)
+    def cost():
+        cost.k += 1
+        costFunction(paramsArr * (1 + 1e-6*cost.k), workers, weights, targets, constr)
+    cost.k = 0
+
+    stages = dict(prepare=lambda: [prepareMolecule(m, atomType, typing, max(args.max_order, 1)) for m in mols], \
+        createWorker=lambda: [createWorkerFromData(d, prm, method, bondParams=bondPrm, **kwargs) for d in molDatas], \
+        coulombIntegrals=lambda: [w.coulombIntegrals() for w in workers], precompute=precompute, compute=compute, \
+        computeWithJacobian=lambda: compute(jacobian=True), costFunction=cost)
+    if len(bondWorkers) > 0:
+        stages["calcBondJMatrix"] = lambda: [w.calcBondJMatrix(w.coulomb, w.bVars) for w in bondWorkers]
+
+    results = []
+    for stage in STAGES:
+        if stage not in stages or stage not in args.stages:
+            continue
+        res = timeStage(stages[stage], args.repeat, not args.no_memory)
+        res.update(case=name, method=method, stage=stage, molecules=len(mols), \
+            atoms=int(sum(w.N for w in workers)), maxAtoms=int(max(w.N for w in workers)), \
+            bonds=int(sum(w.B for w in bondWorkers)) if len(bondWorkers) > 0 else None)
+        results.append(res)
+        log("%-14s %-10s %-20s %10.4f s" % (name, method, stage, res["median"]))
+    return results
+
+
+def gitRevision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def log(message):
+    sys.stderr.write(message + "\n")
+    sys.stderr.flush()
+
+def run(args):
+    params, bondParamTable = loadParameters()
+    results = []
+    for name, mols, targets in createCases(args):
+        for method in args.methods:
+            results += benchmarkCase(name, mols, targets, method, params, bondParamTable, args)
+    meta = dict(time=time.strftime("%Y-%m-%dT%H:%M:%S"), revision=gitRevision(), python=platform.python_version(), \
+        numpy=np.__version__, scipy=scipy.__version__, pandas=pd.__version__, rdkit=rdBase.rdkitVersion, \
+        platform=platform.platform(), processor=platform.processor(), cpus=os.cpu_count(), \
+        config={k: v for k, v in vars(args).items() if k not in ["output", "compare"]})
+    with open(args.output, "w") as f:
+        json.dump(dict(meta=meta, results=results), f, indent=1)
+    log("written " + args.output)
+
+
+# largest deviation between runSweep and a fresh worker per case and configuration
+# geometry adopted from another method must give the same charges, on ring systems as well (spanning tree of QEqBond)
+# returns the number of configurations above tol
+def checkSweep(args, tol=1e-10):
+    params, bondParamTable = loadParameters()
+    configurations = sweepGrid(args.methods, maxOrder=sorted(set([1, args.max_order])), fpepsi=(args.fpepsi,), \
+        kappa=(args.kappa,), lam=(args.lam,))
+    maxOrderBound = max(args.max_order, 1)
+    failures = 0
+    print("%-14s %-10s %8s %6s %6s %6s %10s" % ("case", "method", "maxOrder", "fpepsi", "kappa", "lam", "deviation"))
+    for name, mols, _ in createCases(args):
+        molData = [prepareMolecule(mol, atomType, bondType, maxOrderBound) for mol in mols]
+        charges, _, errors = runSweep(molData, params, configurations, atomType, bondType, bondParamTable, nprocs=1)
+        for k, error in errors:
+            log(name + " molecule " + str(k) + ": " + error)
+            failures += 1
+        if len(charges) == 0:
+            continue
+        for config in configurations:
+            method = config["method"]
+            p, bp = createParameters(params, method, copy=False, bondParamTable=bondParamTable)
+            selected = charges
+            for c in config:
+                selected = selected[selected[c] == config[c]]
+            deviation = 0.
+            for k, data in enumerate(molData):
+                worker = createWorkerFromData(data, p, method, bondParams=bp, maxOrder=config["maxOrder"], \
+                    fpepsi=config["fpepsi"], kappa=config["kappa"], lam=config["lam"])
+                swept = selected[selected["molecule"] == k]["charge"].to_numpy()
+                if len(swept) > 0:
+                    deviation = max(deviation, np.max(np.abs(swept - worker.compute())))
+            flag = ""
+            if deviation > tol:
+                flag = "differs"
+                failures += 1
+            print("%-14s %-10s %8d %6s %6g %6g %10.2e %s" % (name, method, config["maxOrder"], config["fpepsi"], \
+                config["kappa"], config["lam"], deviation, flag))
+    return failures
+
+
+# median time ratio new/old per case, method and stage
+# returns the number of entries slower than threshold
+def compare(oldFile, newFile, threshold):
+    with open(oldFile) as f:
+        old = {(r["case"], r["method"], r["stage"]): r for r in json.load(f)["results"]}
+    with open(newFile) as f:
+        new = json.load(f)["results"]
+    regressions = 0
+    print("%-14s %-10s %-20s %10s %10s %7s %7s" % ("case", "method", "stage", "old (s)", "new (s)", "time", "memory"))
+    for r in new:
+        o = old.get((r["case"], r["method"], r["stage"]), None)
+        if o is None:
+            continue
+        ratio = r["median"] / o["median"] if o["median"] > 0 else np.inf
+        memory = r["peakMemory"] / o["peakMemory"] if r["peakMemory"] and o["peakMemory"] else np.nan
+        flag = ""
+        if ratio > threshold:
+            flag = "slower"
+            regressions += 1
+        elif ratio < 1 / threshold:
+            flag = "faster"
+        print("%-14s %-10s %-20s %10.4f %10.4f %7.2f %7.2f %s" % (r["case"], r["method"], r["stage"], o["median"], r["median"], \
+            ratio, memory, flag))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the qcalc pipeline stages")
+    parser.add_argument("--output", default="benchmarks.json")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files instead of running")
+    parser.add_argument("--threshold", type=float, default=1.2, help="time ratio reported as a regression")
+    parser.add_argument("--check-sweep", action="store_true", help="compare runSweep with fresh workers instead of running")
+    parser.add_argument("--methods", nargs="+", default=METHODS, choices=METHODS)
+    parser.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES)
+    parser.add_argument("--sets", nargs="*", default=["molecules_ddec", "molecules_marina"])
+    parser.add_argument("--limit", type=int, default=None, help="number of molecules per set")
+    parser.add_argument("--chain", nargs="*", type=int, default=[32, 128, 512, 2048], help="chain lengths (carbons)")
+    parser.add_argument("--fused", nargs="*", type=int, default=[8, 32, 128, 512], help="number of fused rings")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-memory", action="store_true", help="skip the peak memory runs")
+    parser.add_argument("--max-order", type=int, default=2)
+    parser.add_argument("--fpepsi", action="store_true")
+    parser.add_argument("--kappa", type=float, default=1)
+    parser.add_argument("--lam", type=float, default=1)
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        return 1 if compare(*args.compare, args.threshold) > 0 else 0
+    if args.check_sweep:
+        return 1 if checkSweep(args) > 0 else 0
+    run(args)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
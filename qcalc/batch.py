@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import numpy as np
+
+# solves many molecules at once
+# dense workers of the same method and size are stacked into K x N x N arrays and solved in one
+# batched np.linalg.solve; methods without a stackedSystem (bond methods) are computed one by one
+# the Coulomb matrices are copied at construction, rebuild the batch after changing geometry
+# setParams and compute keep the wrapped workers up to date (parameters, charges, electronegativityEq),
+# so they can still be used on their own
+class BatchSolver:
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.serial = []
+        groups = dict()
+        for k, worker in enumerate(workers):
+            if hasattr(worker, "stackedSystem") and not worker.sparse:
+                groups.setdefault((type(worker), worker.N), []).append(k)
+            else:
+                self.serial.append(k)
+
+        self.buckets = []
+        for (cls, N), positions in groups.items():
+            members = [workers[k] for k in positions]
+            for worker in members:
+                worker.precompute()
+            bucket = dict()
+            bucket["cls"] = cls
+            bucket["N"] = N
+            bucket["positions"] = positions
+            bucket["coulomb"] = np.stack([w.coulomb for w in members])
+            bucket["netCharge"] = np.array([w.netCharge for w in members], dtype=float)
+            bucket["electronegativity"] = np.stack([w.electronegativity for w in members])
+            bucket["hardness"] = np.stack([w.hardness for w in members])
+            bucket["elnegIndices"] = np.stack([w.elnegIndices for w in members])
+            bucket["hardnessIndices"] = np.stack([w.hardnessIndices for w in members])
+            self.buckets.append(bucket)
+
+    # for optimization
+    def setParams(self, paramsArr):
+        for bucket in self.buckets:
+            bucket["electronegativity"] = paramsArr[bucket["elnegIndices"]]
+            bucket["hardness"] = paramsArr[bucket["hardnessIndices"]]
+            for k, electronegativity, hardness in zip(bucket["positions"], bucket["electronegativity"], bucket["hardness"]):
+                self.workers[k].electronegativity = electronegativity
+                self.workers[k].hardness = hardness
+        for k in self.serial:
+            self.workers[k].setParams(paramsArr)
+
+    # returns list of charges in the order of the workers
+    def compute(self):
+        charges = [None] * len(self.workers)
+
+        for bucket in self.buckets:
+            N = bucket["N"]
+            diagonal = np.arange(N)
+            JMatrix = bucket["coulomb"].copy()
+            JMatrix[:, diagonal, diagonal] += bucket["hardness"]
+            X, Y = bucket["cls"].stackedSystem(JMatrix, bucket["electronegativity"], bucket["netCharge"])
+            res = np.linalg.solve(X, Y[..., None])[..., 0]
+            for i, k in enumerate(bucket["positions"]):
+                self.workers[k].charges = res[i, :N]
+                # EEM: the Lagrange multiplier is the last unknown
+                if res.shape[1] > N:
+                    self.workers[k].electronegativityEq = res[i, N]
+                charges[k] = res[i, :N]
+
+        for k in self.serial:
+            charges[k] = self.workers[k].compute()
+
+        return charges
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import hashlib
+import inspect
+import numpy as np
+from rdkit import Chem
+from qcalc.workers import prepareMolecule
+from qcalc.util.rdkitUtils import extractCharges
+
+# bump whenever the content of the cached molData changes
+CACHE_VERSION = 1
+
+# identity of a typing function: qualified name and source code
+# (functions it calls are not included)
+def functionIdentity(func):
+    if func is None:
+        return "None"
+    try:
+        code = inspect.getsource(func)
+    except (OSError, TypeError):
+        code = func.__code__.co_code.hex() if hasattr(func, "__code__") else repr(func)
+    return getattr(func, "__module__", "") + "." + getattr(func, "__qualname__", repr(func)) + "\n" + code
+
+# read an SDF/mol file with DDEC-style charges (molFileAlias) and preprocess it
+# returns molData as from prepareMolecule, plus "targetCharges" if the file has charges on every atom
+def readMolecule(path, atomTypeFunc, bondTypeFunc=None):
+    mol = Chem.MolFromMolFile(path, removeHs=False)
+    if mol is None:
+        raise Exception("could not read molecule from " + path)
+    try:
+        targetCharges = extractCharges(mol)
+    except KeyError:
+        targetCharges = None
+    molData = prepareMolecule(Chem.RemoveHs(mol), atomTypeFunc, bondTypeFunc)
+    if targetCharges is not None:
+        molData["targetCharges"] = targetCharges
+    return molData
+
+# persistent store of preprocessed molecules, one npz file per entry
+# entries are keyed by the file content and the typing functions, so a changed file or typing rule
+# simply misses the cache; stale entries can be removed with clear()
+class MoleculeCache:
+
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+        os.makedirs(cacheDir, exist_ok=True)
+
+    def key(self, path, atomTypeFunc, bondTypeFunc=None):
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            h.update(f.read())
+        h.update(functionIdentity(atomTypeFunc).encode())
+        h.update(functionIdentity(bondTypeFunc).encode())
+        h.update(str(CACHE_VERSION).encode())
+        return h.hexdigest()
+
+    # molData of readMolecule, RDKit only runs on cache misses
+    def load(self, path, atomTypeFunc, bondTypeFunc=None):
+        cacheFile = os.path.join(self.cacheDir, self.key(path, atomTypeFunc, bondTypeFunc) + ".npz")
+        if os.path.exists(cacheFile):
+            with np.load(cacheFile, allow_pickle=True) as data:
+                return {k: data[k] for k in data.files}
+
+        molData = readMolecule(path, atomTypeFunc, bondTypeFunc)
+
+        # write to a temporary file first, concurrent runs never see partial entries
+        tmpFile = cacheFile + "." + str(os.getpid()) + ".tmp"
+        with open(tmpFile, "wb") as f:
+            np.savez(f, **molData)
+        os.replace(tmpFile, cacheFile)
+        return molData
+
+    def loadAll(self, paths, atomTypeFunc, bondTypeFunc=None):
+        return [self.load(path, atomTypeFunc, bondTypeFunc) for path in paths]
+
+    def clear(self):
+        for f in os.listdir(self.cacheDir):
+            if f.endswith(".npz"):
+                os.remove(os.path.join(self.cacheDir, f))
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import sys
+import argparse
+import importlib
+import pandas as pd
+from qcalc.stream import chargeFile
+
+# "module:function" -> function
+def importFunction(spec):
+    moduleName, funcName = spec.split(":")
+    return getattr(importlib.import_module(moduleName), funcName)
+
+# whitespace-separated table (csv with --sep ,), columns renamed with "old=new,old2=new2"
+def readTable(path, sep, rename):
+    table = pd.read_csv(path, sep=sep)
+    if rename:
+        table = table.rename(columns=dict(pair.split("=") for pair in rename.split(",")))
+    return table
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="qcalc", description="Assign partial charges to a library of molecules")
+    parser.add_argument("input", help="input molecules (.sdf, .sdf.gz, .smi)")
+    parser.add_argument("output", help="output file (.sdf or .csv)")
+    parser.add_argument("--method", default="EEM", choices=["EEM", "QeqAtomic", "QeqBond", "AACT", "SQE"])
+    parser.add_argument("--params", required=True, help="atomic parameter table (atom, diameter, hardness, electronegativity)")
+    parser.add_argument("--bond-params", help="bond parameter table (type, hardness, electronegativity), AACT and SQE")
+    parser.add_argument("--atom-types", required=True, help="atom typing function as module:function")
+    parser.add_argument("--bond-types", help="bond typing function as module:function, AACT and SQE")
+    parser.add_argument("--sep", default=r"\s+", help="column separator of the parameter tables")
+    parser.add_argument("--rename", default="", help="rename table columns, e.g. '#atnm=atom,hrd=hardness'")
+    parser.add_argument("--max-order", type=int, default=1)
+    parser.add_argument("--fpepsi", action="store_true")
+    parser.add_argument("--kappa", type=float, default=1)
+    parser.add_argument("--lam", type=float, default=1)
+    parser.add_argument("--net-charge", default="0", help="total charge, or 'formal' for the formal charge of each molecule")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    kwargs = dict(maxOrder=args.max_order, fpepsi=args.fpepsi, kappa=args.kappa, lam=args.lam)
+    kwargs["netCharge"] = args.net_charge if args.net_charge == "formal" else float(args.net_charge)
+    if args.bond_params:
+        kwargs["bondParamTable"] = readTable(args.bond_params, args.sep, args.rename)
+    if args.bond_types:
+        kwargs["bondTypeFunc"] = importFunction(args.bond_types)
+
+    paramTable = readTable(args.params, args.sep, args.rename)
+    atomTypeFunc = importFunction(args.atom_types)
+    stats = chargeFile(args.input, args.output, paramTable, args.method, atomTypeFunc, args.chunk_size, **kwargs)
+    sys.stderr.write("done: %d molecules, %d failed, %.1f s\n" % (stats["molecules"], stats["failures"], stats["seconds"]))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
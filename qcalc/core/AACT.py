@@ -2,6 +2,7 @@
 # coding: utf-8
 
 import numpy as np
+from qcalc import instrument
 from qcalc.core.BondChargeDistributionMethod import BondChargeDistributionMethod
 
 class AACT (BondChargeDistributionMethod):
@@ -20,32 +21,64 @@ class AACT (BondChargeDistributionMethod):
         self.bondHardness = bondHardness
         self.electronegativity = electronegativity
 
-        # 2B overwritten in compute
+        # 2B overwritten in precompute
         self.B = len(bondHardness)
         
     
+    # parameter-dependent part of the bond hardness matrix
+    def bondDiagonal (self):
+        return np.diag(2 * self.bondHardness)
+
+    # for low-rank updates (see solveSymmetric)
+    def updateDiagonal (self):
+        return 2 * self.bondHardness
+
+    def updateBasis (self, changed):
+        return self.unitColumns(self.B, changed)
+
+    
     def compute (self):
+        t = instrument.start()
         
-        # here, the atomic J matrix has 0 on the diagonal
-        self.JMatrix = self.coulombIntegrals()
+        # here, the atomic J matrix has 0 on the diagonal (see atomicDiagonal)
+        # Coulomb integrals and their bond-space transform are cached
+        self.precompute()
         
         # transform to bond variables
-        self.bVars = self.bondVars()
         self.checkDim(self.bondHardness, self.B)
         self.bondElneg = self.bondElectronegativity(self.electronegativity, self.bVars)
-        self.bondJMatrix = self.calcBondJMatrix(self.JMatrix, self.bVars)
         
         # add bond hardness on the diagonal
-        self.bondJMatrix = self.bondJMatrix + 2 * np.diag(self.bondHardness)
+        self.bondJMatrix = self.bondCoulomb + self.bondDiagonal()
         
         # solve system
         self.bondCharges = self.solve(self.bondElneg, self.bondJMatrix)
         self.charges = self.toAtomicCharges(self.bondCharges, self.bVars)
+        instrument.stop("compute.AACT", t, self.N)
         return self.charges
 
+    # charges and their derivatives w.r.t. electronegativity and bond hardness
+    # jacobian: N x (N+B), columns map to paramsArr via self.jacobianIndices
+    def computeWithJacobian (self):
+        t = instrument.start()
+
+        self.precompute()
+        self.checkDim(self.bondHardness, self.B)
+        self.bondElneg = self.bondElectronegativity(self.electronegativity, self.bVars)
+        self.bondJMatrix = self.bondCoulomb + self.bondDiagonal()
+
+        self.bondCharges, bondJInverse = self.solveWithInverse(self.bondElneg, self.bondJMatrix)
+        self.charges = self.toAtomicCharges(self.bondCharges, self.bVars)
+
+        G, R = self.chargeResponse(bondJInverse, self.bVars)
+        self.jacobian = np.hstack((-G, -R * 2 * self.bondCharges))
+        instrument.stop("computeWithJacobian.AACT", t, self.N)
+        return self.charges, self.jacobian
+
     def setIndices(self, indices, bondIndices, ntypes):
         self.elnegIndices = indices
         self.bondHardnessIndices = bondIndices + ntypes
+        self.jacobianIndices = np.concatenate((self.elnegIndices, self.bondHardnessIndices))
 
     # for optimization
     def setParams(self, paramsArr):
@@ -2,9 +2,17 @@
 # coding: utf-8
 
 import numpy as np
+from scipy.sparse import csr_matrix, issparse, triu
+from scipy.sparse.csgraph import minimum_spanning_tree, connected_components
+from scipy.sparse.linalg import splu
+from qcalc import instrument
 from qcalc.core.ChargeDistributionMethod import ChargeDistributionMethod
 
 class BondChargeDistributionMethod (ChargeDistributionMethod):
+
+    # True if the bond hardness matrix is singular for B > N-1 (charge transfer around cycles is undetermined),
+    # such systems are reduced to the bonds of a spanning tree, see solveTree
+    treeReduction = False
     
     def __init__(self, connectivity, distanceMatrix, diameters, chargeTransferTopology, netCharge=0, maxOrder=1, fpepsi=False):
             
@@ -12,64 +20,313 @@ class BondChargeDistributionMethod (ChargeDistributionMethod):
         
         self.checkDim(chargeTransferTopology, self.N)
         self.chargeTransferTopology = chargeTransferTopology
-        
-        
+
+
+    def invalidateGeometry (self):
+        super().invalidateGeometry()
+        self.bVars = None
+        self.incidence = None
+        self.incidenceT = None
+        self.bondPattern = None
+        self.bondCoulomb = None
+        self.treeBonds = None
+        self.laplacian = None
+        self.laplacianFactor = None
+
+
+    # the LU factor of the grounded Laplacian cannot be pickled, it is rebuilt on first use
+    def __getstate__ (self):
+        state = self.__dict__.copy()
+        state["laplacianFactor"] = None
+        return state
+
+
+    # bond variables and the bond-space Coulomb matrix can only come from another bond method
+    def adoptGeometry (self, other):
+        super().adoptGeometry(other)
+        if isinstance(other, BondChargeDistributionMethod) and other.bondCoulomb is not None:
+            self.bVars = other.bVars
+            self.B = len(other.bVars)
+            self.incidence = other.incidence
+            self.incidenceT = other.incidenceT
+            self.bondPattern = other.bondPattern
+            self.bondCoulomb = other.bondCoulomb
+            # the spanning tree only for methods with singular ring systems, the others solve the full system
+            if self.treeReduction and other.treeBonds is not None:
+                self.treeBonds = other.treeBonds
+                self.laplacian = other.laplacian
+                self.laplacianFactor = other.laplacianFactor
+
+
+    def setGeometry (self, connectivity=None, distanceMatrix=None, diameters=None, chargeTransferTopology=None):
+        if chargeTransferTopology is not None:
+            self.checkDim(chargeTransferTopology, self.N)
+            self.chargeTransferTopology = chargeTransferTopology
+        super().setGeometry(connectivity, distanceMatrix, diameters)
+
+
+    # bond-space systems are always dense
+    def setSparse (self, sparse=True, cutoff=None, solver="cg", tol=1e-10, maxiter=None):
+        if sparse:
+            raise Exception("sparse mode is only available for EEM and QEqAtomic")
+        super().setSparse(sparse, cutoff, solver, tol, maxiter)
+
+
+    # bond variables and the bond-space Coulomb matrix only depend on geometry
+    def precompute (self):
+        super().precompute()
+        self.precomputeTopology()
+        if self.bondCoulomb is None:
+            t = instrument.start()
+            self.bondCoulomb = self.calcBondJMatrix(self.coulomb, self.bVars)
+            instrument.stop("calcBondJMatrix", t, self.B)
+
+
+    # bond variables, incidence matrix and spanning tree, no Coulomb integrals needed
+    def precomputeTopology (self):
+        if self.bVars is None:
+            self.bVars = self.bondVars()
+        if self.incidence is None:
+            self.incidence = self.incidenceMatrix(self.bVars)
+            self.incidenceT = self.incidence.T.tocsr()
+            self.bondPattern = self.bondDiagonalPattern(self.bVars)
+        if self.treeReduction and self.treeBonds is None and self.B > self.N - 1:
+            t = instrument.start()
+            self.treeBonds = self.spanningTree(self.bVars)
+            self.laplacian = self.groundedLaplacian(self.bVars)
+            instrument.stop("spanningTree", t, self.B)
+
+
     # get bond variable definitions as pairs of indices
     def bondVars (self):
-        bVars = np.argwhere(self.chargeTransferTopology)
-        upperTriangle = np.where(bVars[:,0] < bVars[:,1])
-        bVars = bVars[upperTriangle]
+        if issparse(self.chargeTransferTopology):
+            # row-major order, same as argwhere
+            upper = triu(self.chargeTransferTopology, 1, format="csr")
+            upper.sort_indices()
+            upper = upper.tocoo()
+            bVars = np.column_stack((upper.row, upper.col)).astype(np.intp)
+        else:
+            bVars = np.argwhere(self.chargeTransferTopology)
+            upperTriangle = np.where(bVars[:,0] < bVars[:,1])
+            bVars = bVars[upperTriangle]
         self.B = len(bVars)
         return bVars
 
     
-    # map bond charges to atoms
+    # bond-atom incidence matrix C (N x B, sparse)
+    # bond b = (i, j) moves charge from atom i to atom j: C[i,b] = -1, C[j,b] = 1
+    # transpose=True returns C^T as CSR
+    # the cached matrices are reused when called with the cached bond variables
+    def incidenceMatrix (self, bVars, transpose=False):
+        if bVars is self.bVars and self.incidence is not None:
+            return self.incidenceT if transpose else self.incidence
+        B = len(bVars)
+        rows = np.concatenate((bVars[:,0], bVars[:,1]))
+        cols = np.tile(np.arange(B), 2)
+        data = np.concatenate((-np.ones(B), np.ones(B)))
+        C = csr_matrix((data, (rows, cols)), shape=(self.N, B))
+        return C.T.tocsr() if transpose else C
+
+
+    # off-diagonal nonzeros of C^T diag(d) C
+    # two different bonds couple only through their (single) shared atom
+    # returns rows, cols, shared atoms and signs
+    def bondDiagonalPattern (self, bVars):
+        if bVars is self.bVars and self.bondPattern is not None:
+            return self.bondPattern
+        C = self.incidenceMatrix(bVars)
+        S = (self.incidenceMatrix(bVars, transpose=True) @ C).tocoo()
+        offDiagonal = S.row != S.col
+        rows, cols, signs = S.row[offDiagonal], S.col[offDiagonal], S.data[offDiagonal]
+        I, K = bVars[:,0], bVars[:,1]
+        shared = np.where((I[rows] == I[cols]) | (I[rows] == K[cols]), I[rows], K[rows])
+        return rows, cols, shared, signs
+
+    
+    # indices of bonds forming a spanning tree (forest for several fragments)
+    # Kruskal with the bond index as weight keeps the first bonds
+    def spanningTree (self, bVars):
+        B = len(bVars)
+        graph = csr_matrix((np.arange(1, B + 1), (bVars[:,0], bVars[:,1])), shape=(self.N, self.N))
+        tree = minimum_spanning_tree(graph)
+        return np.sort(tree.data.astype(int) - 1)
+
+
+    # graph Laplacian C C^T with one grounded atom per fragment
+    # returns the free atoms and the Laplacian on them (factored in minimumNormBondCharges)
+    def groundedLaplacian (self, bVars):
+        C = self.incidenceMatrix(bVars)
+        L = (C @ C.T).tocsc()
+        _, labels = connected_components(L, directed=False)
+        _, grounded = np.unique(labels, return_index=True)
+        free = np.setdiff1d(np.arange(self.N), grounded)
+        return free, L[free][:,free].tocsc()
+
+
+    # bond charges with the same charge transfer C qb and minimum norm: C^T L^+ C qb
+    # bondCharges can also be B x K (one column per system)
+    def minimumNormBondCharges (self, bondCharges):
+        free, laplacian = self.laplacian
+        if self.laplacianFactor is None:
+            self.laplacianFactor = splu(laplacian)
+        transfer = self.incidenceMatrix(self.bVars) @ bondCharges
+        potential = np.zeros(transfer.shape)
+        potential[free] = self.laplacianFactor.solve(transfer[free])
+        return self.incidenceMatrix(self.bVars, transpose=True) @ potential
+
+    
+    # map bond charges to atoms: q = netCharge/N + C qb
     def toAtomicCharges(self, bondCharges, bVars):
-        charges = np.repeat(self.netCharge / self.N, self.N)
-        for b, [i, j] in enumerate(bVars):
-            charges[i] = charges[i] - bondCharges[b]
-            charges[j] = charges[j] + bondCharges[b]
+        C = self.incidenceMatrix(bVars)
+        charges = np.repeat(self.netCharge / self.N, self.N) + C @ bondCharges
         return charges  
 
     
-    # electronegativity vector in bond variables
+    # diagonal of the atomic J matrix, None: Coulomb integrals only
+    def atomicDiagonal (self):
+        return None
+
+    # atomic J matrix, only built when read: the bond solve uses the cached bond-space transform
+    # and the parameter-dependent bondDiagonal
+    @property
+    def JMatrix (self):
+        diagonal = self.atomicDiagonal()
+        if diagonal is None:
+            return self.coulomb
+        return self.addDiagonal(self.coulomb, diagonal)
+
+
+    # electronegativity vector in bond variables: C^T chi
     def bondElectronegativity (self, electronegativity, bVars): 
-        bondElneg = np.zeros(self.B)  
-        for b, [i, j] in enumerate(bVars):
-            bondElneg[b] = electronegativity[j] - electronegativity[i]  
+        CT = self.incidenceMatrix(bVars, transpose=True)
+        bondElneg = CT @ electronegativity
         return bondElneg   
  
 
-    # transform J Matrix to bond space
-    # hardness: 1D vector (N)
+    # transform J Matrix to bond space: C^T J C
+    # JMatrix: N x N
     # res: B x B (B: #entries in upper triangle of CTT matrix)
     def calcBondJMatrix (self, JMatrix, bVars):
+        CT = self.incidenceMatrix(bVars, transpose=True)
+        bondJMatrix = CT @ (CT @ JMatrix).T
+        return bondJMatrix.T
     
-        # initialize B x B hardness matrix
-        B = self.B
-        bondJMatrix = np.zeros((B, B))
-    
-        # construct hardness matrix
-        for b1, [i, j] in enumerate(bVars):
-            for b2, [k, l] in enumerate(bVars):
-                bondJMatrix[b1, b2] = JMatrix[i,k] - JMatrix[i,l] - JMatrix[j,k] + JMatrix[j,l]
-        
-        return bondJMatrix
+
+    # transform a diagonal atomic matrix to bond space: C^T diag(d) C
+    # diagonal: 1D vector (N)
+    # res: B x B
+    def calcBondDiagonal (self, diagonal, bVars):
+        rows, cols, shared, signs = self.bondDiagonalPattern(bVars)
+        B = len(bVars)
+        bondDiagonal = np.zeros((B, B))
+        bondDiagonal[rows, cols] = signs * diagonal[shared]
+        bondDiagonal[np.arange(B), np.arange(B)] = diagonal[bVars[:,0]] + diagonal[bVars[:,1]]
+        return bondDiagonal
     
     
     # B x B system of equations
     # returns bond charges
     def solve (self, bondElneg, bondJMatrix):
     
-        # system only has an unique solution for N-1 bond variables
-        # otherwise we use SVD to get a particular solution instead
-        if self.B <= self.N - 1:
-            bondCharges = np.linalg.solve(bondJMatrix, -bondElneg)
-        else: 
-            # https://stackoverflow.com/questions/59292279/solving-linear-systems-of-equations-with-svd-decomposition
-            U, s, Vh = np.linalg.svd(bondJMatrix)
-            c = np.dot(U.T, -bondElneg)
-            w = np.dot(np.diag(1/s), c)
-            bondCharges = np.dot(Vh.conj().T, w)
+        # system only has an unique solution for N-1 bond variables, or with bond hardness terms on the diagonal
+        # C^T J C is symmetric positive definite for positive definite J: Cholesky, LU otherwise
+        # singular ring systems are solved on a spanning tree, SVD is the last resort
+        if self.B > self.N - 1 and self.treeReduction and self.treeBonds is not None:
+            instrument.count("solve.tree")
+            return self.solveTree(bondElneg, bondJMatrix)
+
+        t = instrument.start()
+        nonsingular = self.B <= self.N - 1 or not self.treeReduction
+        bondCharges = None
+        if nonsingular:
+            bondCharges = self.solveSymmetric(bondJMatrix, -bondElneg)
+            if bondCharges is not None:
+                instrument.count("solve.cholesky")
+        if bondCharges is None and nonsingular:
+            try:
+                bondCharges = np.linalg.solve(bondJMatrix, -bondElneg)
+                instrument.count("solve.lu")
+            except np.linalg.LinAlgError:
+                bondCharges = self.solveSVD(bondElneg, bondJMatrix)
+        elif bondCharges is None:
+            bondCharges = self.solveSVD(bondElneg, bondJMatrix)
+        instrument.stop("solve", t, self.B)
         
-        return bondCharges
\ No newline at end of file
+        return bondCharges
+
+
+    # particular solution of a singular system
+    def solveSVD (self, bondElneg, bondJMatrix):
+        instrument.count("solve.svd")
+        # https://stackoverflow.com/questions/59292279/solving-linear-systems-of-equations-with-svd-decomposition
+        U, s, Vh = np.linalg.svd(bondJMatrix)
+        c = np.dot(U.T, -bondElneg)
+        w = np.dot(np.diag(1/s), c)
+        return np.dot(Vh.conj().T, w)
+
+
+    # singular ring system on the spanning tree bonds T: M[T,T] = C_T^T J C_T is nonsingular
+    # and C_T q_T gives the same charge transfer as every solution of the full system
+    # returns minimum-norm bond charges (and a generalized inverse of M, nonzero on T x T only)
+    def solveTree (self, bondElneg, bondJMatrix, inverse=False):
+        t = instrument.start()
+        T = self.treeBonds
+        treeJMatrix = bondJMatrix[np.ix_(T, T)]
+        rhs = -bondElneg[T]
+        if inverse:
+            rhs = np.column_stack((rhs, np.eye(len(T))))
+        res = self.solveSymmetric(treeJMatrix, rhs, T, update=not inverse)
+        if res is None:
+            res = self.solveGeneral(treeJMatrix, rhs)
+
+        bondCharges = np.zeros(self.B)
+        bondCharges[T] = res[:,0] if inverse else res
+        bondCharges = self.minimumNormBondCharges(bondCharges)
+        instrument.stop("solveTree", t, len(T))
+        if not inverse:
+            return bondCharges
+        bondJInverse = np.zeros((self.B, self.B))
+        bondJInverse[np.ix_(T, T)] = res[:,1:]
+        return bondCharges, bondJInverse
+
+
+    # bond charges together with the inverse of the bond hardness matrix, from one factorization
+    # singular ring systems: spanning tree, or the pseudo-inverse which drops the singular (cycle) directions
+    def solveWithInverse (self, bondElneg, bondJMatrix):
+        if self.B > self.N - 1 and self.treeReduction and self.treeBonds is not None:
+            instrument.count("solveWithInverse.tree")
+            return self.solveTree(bondElneg, bondJMatrix, inverse=True)
+        nonsingular = self.B <= self.N - 1 or not self.treeReduction
+        rhs = np.column_stack((-bondElneg, np.eye(self.B)))
+        res = self.solveSymmetric(bondJMatrix, rhs, update=False) if nonsingular else None
+        if res is not None:
+            instrument.count("solveWithInverse.cholesky")
+            return res[:,0], res[:,1:]
+        if nonsingular:
+            try:
+                res = np.linalg.solve(bondJMatrix, rhs)
+                instrument.count("solveWithInverse.lu")
+                return res[:,0], res[:,1:]
+            except np.linalg.LinAlgError:
+                pass
+        instrument.count("solveWithInverse.pinv")
+        bondJInverse = np.linalg.pinv(bondJMatrix, hermitian=True)
+        return bondJInverse @ -bondElneg, bondJInverse
+
+
+    # derivatives of atomic charges from the inverse bond hardness matrix
+    # returns C M^-1 C^T (response to atomic perturbations) and C M^-1 (response to bond perturbations)
+    def chargeResponse (self, bondJInverse, bVars):
+        C = self.incidenceMatrix(bVars)
+        bondResponse = C @ bondJInverse
+        atomResponse = C @ bondResponse.T
+        return atomResponse, bondResponse
+
+
+    # charges for a vector of K net charges from one solve
+    # the bond charges do not depend on netCharge, only the uniform offset netCharge/N does
+    # returns K x N charges
+    def computeNetChargeScan (self, netCharges):
+        netCharges = np.atleast_1d(np.asarray(netCharges, dtype=float))
+        charges = self.compute()
+        return charges + np.outer(netCharges - self.netCharge, np.ones(self.N)) / self.N
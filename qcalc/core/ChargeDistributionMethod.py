@@ -3,8 +3,28 @@
 
 import numpy as np
 from scipy.special import erf
+from scipy.linalg import cho_factor, cho_solve
+from scipy.sparse import coo_matrix, diags, bmat, issparse, triu
+from scipy.sparse.linalg import cg, minres
+from qcalc import instrument
 
 class ChargeDistributionMethod:
+
+    # global default for coulombIntegrals, can be overridden per call
+    vectorized = True
+
+    # Coulomb interactions beyond this distance (nm) are dropped, None keeps all
+    cutoff = None
+
+    # sparse mode (EEM, QEqAtomic): CSR Coulomb/J matrices and a Krylov solver, see setSparse
+    sparse = False
+    krylovSolver = "cg"
+    krylovTol = 1e-10
+    krylovMaxiter = None
+
+    # dense solves reuse the last Cholesky factorization through low-rank (Woodbury) updates
+    # if at most this fraction of the parameter-dependent diagonal changed, see solveSymmetric
+    woodburyThreshold = 0.1
     
     def __init__(self, connectivity, distanceMatrix, diameters, netCharge=0, maxOrder=1, fpepsi=False):
         # some basic error checking
@@ -20,9 +40,13 @@ class ChargeDistributionMethod:
         self.fpepsi = fpepsi
         self.N = N
         self.netCharge = netCharge
+
+        # geometry-only quantities are filled lazily by precompute()
+        self.invalidateGeometry()
         
     
     # generic material for dimensionality checks
+    # connectivity and distanceMatrix can also be sparse (see getSparseConnectivity, getSparseDistances)
     def checkDim (self, obj, N):
         if len(obj.shape) == 1:
             assert len(obj) == N, "Error: got vector of length " + str(len(obj)) + ", expected " + str(N)
@@ -30,19 +54,321 @@ class ChargeDistributionMethod:
             assert obj.shape == (N, N), "Error: got matrix of shape " + str(obj.shape) + ", expected (" + str(N) + "," + str(N) + ")"
         
         
-    def coulombIntegrals (self):
+    # drop cached geometry-only quantities
+    # needed after changing connectivity, distances, diameters, maxOrder, fpepsi or cutoff
+    def invalidateGeometry (self):
+        self.coulomb = None
+        self.factorization = None
+        self.factorDiagonal = None
+
+
+    # share the geometry-only caches of another worker of the same molecule
+    # (same distances, diameters, maxOrder, fpepsi and cutoff), e.g. across methods; arrays are shared, not copied
+    def adoptGeometry (self, other):
+        if other.coulomb is not None:
+            self.coulomb = other.coulomb
+
+
+    def setGeometry (self, connectivity=None, distanceMatrix=None, diameters=None):
+        if connectivity is not None:
+            self.checkDim(connectivity, self.N)
+            self.connectivity = connectivity
+        if distanceMatrix is not None:
+            self.checkDim(distanceMatrix, self.N)
+            self.distanceMatrix = distanceMatrix
+        if diameters is not None:
+            self.checkDim(diameters, self.N)
+            self.diameters = diameters
+        self.invalidateGeometry()
+
+
+    # switch between dense matrices with LAPACK solves and sparse matrices with Krylov solves
+    # solver: "cg" (J positive definite) or "minres" (any symmetric J)
+    def setSparse (self, sparse=True, cutoff=None, solver="cg", tol=1e-10, maxiter=None):
+        if solver not in ["cg", "minres"]:
+            raise Exception("solver " + solver + " is undefined")
+        self.sparse = sparse
+        self.cutoff = cutoff
+        self.krylovSolver = solver
+        self.krylovTol = tol
+        self.krylovMaxiter = maxiter
+        self.invalidateGeometry()
+
+
+    # compute everything that does not depend on optimized parameters
+    # kept between setParams/compute calls
+    def precompute (self):
+        if self.coulomb is None:
+            t = instrument.start()
+            if self.sparse:
+                self.coulomb = self.coulombIntegralsSparse()
+            else:
+                self.coulomb = self.coulombIntegrals()
+            instrument.stop("coulombIntegrals", t, self.N)
+
+
+    # matrix + diag(diagonal) as a new array, the cached Coulomb matrix stays untouched
+    def addDiagonal (self, matrix, diagonal):
+        if issparse(matrix):
+            return (matrix + diags(diagonal)).tocsr()
+        res = matrix.copy()
+        res[np.diag_indices_from(res)] += diagonal
+        return res
+
+
+    def coulombIntegrals (self, vectorized=None):
+        # per-call choice, otherwise the class-wide default
+        if vectorized is None:
+            vectorized = self.vectorized
+        # the loop reads single entries of dense matrices
+        if vectorized or issparse(self.connectivity) or issparse(self.distanceMatrix):
+            return self.coulombIntegralsVectorized()
+        return self.coulombIntegralsLoop()
+
+
+    def fpepsiFactor (self):
         if self.fpepsi:
-            FPEPSI = 1.44
-        else:
-            FPEPSI = 1.
+            return 1.44
+        return 1.
+
+
+    # reference implementation, one pair at a time
+    def coulombIntegralsLoop (self):
+        FPEPSI = self.fpepsiFactor()
         N = self.N
         # calculate Coulomb integrals
         coulomb = np.zeros((N, N))
         for i in range(0,N):
             for j in range(i+1,N):
+                if self.cutoff is not None and self.distanceMatrix[i,j] > self.cutoff:
+                    continue
                 if self.connectivity[i,j] <= self.maxOrder:
                     coulomb[i,j] = FPEPSI / self.distanceMatrix[i,j] * erf( self.distanceMatrix[i,j] \
                         / np.sqrt( self.diameters[i]**2 + self.diameters[j]**2 ))
                     coulomb[j,i] = coulomb[i,j]
         return coulomb
 
+
+    # upper-triangle pairs within maxOrder
+    # a sparse connectivity matrix only holds pairs within its depth bound, the pair list is built from its entries
+    def topologicalPairs (self):
+        if issparse(self.connectivity):
+            upper = triu(self.connectivity, 1, format="coo")
+            keep = upper.data <= self.maxOrder
+            return upper.row[keep], upper.col[keep]
+        return np.nonzero(np.triu(self.connectivity <= self.maxOrder, 1))
+
+
+    # upper-triangle pairs within maxOrder (and cutoff) and their Coulomb integrals
+    def coulombPairs (self):
+        FPEPSI = self.fpepsiFactor()
+        iu, ju = self.topologicalPairs()
+        dist = np.asarray(self.distanceMatrix[iu, ju]).ravel()
+        # a sparse distance matrix only holds pairs within its own cutoff
+        keep = dist > 0 if issparse(self.distanceMatrix) else np.ones(len(dist), dtype=bool)
+        if self.cutoff is not None:
+            keep &= dist <= self.cutoff
+        iu, ju, dist = iu[keep], ju[keep], dist[keep]
+        width = np.sqrt(self.diameters[iu]**2 + self.diameters[ju]**2)
+        values = FPEPSI / dist * erf(dist / width)
+        return iu, ju, values
+
+
+    # whole-array kernel over the masked upper triangle
+    def coulombIntegralsVectorized (self):
+        N = self.N
+        coulomb = np.zeros((N, N))
+        iu, ju, values = self.coulombPairs()
+        coulomb[iu, ju] = values
+        coulomb[ju, iu] = values
+        return coulomb
+
+
+    # same as coulombIntegralsVectorized, as CSR matrix
+    def coulombIntegralsSparse (self):
+        N = self.N
+        iu, ju, values = self.coulombPairs()
+        rows = np.concatenate((iu, ju))
+        cols = np.concatenate((ju, iu))
+        return coo_matrix((np.concatenate((values, values)), (rows, cols)), shape=(N, N)).tocsr()
+
+
+    # Coulomb integrals for a stack of K geometries with the same topology (conformers)
+    # distanceMatrices: K x N x N, res: K x N x N
+    def coulombIntegralsStacked (self, distanceMatrices):
+        FPEPSI = self.fpepsiFactor()
+        K, N = len(distanceMatrices), self.N
+        iu, ju = self.topologicalPairs()
+        dist = distanceMatrices[:, iu, ju]
+        width = np.sqrt(self.diameters[iu]**2 + self.diameters[ju]**2)
+        values = FPEPSI / dist * erf(dist / width)
+        if self.cutoff is not None:
+            values = np.where(dist <= self.cutoff, values, 0.)
+        coulomb = np.zeros((K, N, N))
+        coulomb[:, iu, ju] = values
+        coulomb[:, ju, iu] = values
+        return coulomb
+
+
+    # Cholesky factorization of a symmetric matrix (J or C^T J C), kept in self.factorization
+    # for further right-hand sides; None if the matrix is not positive definite
+    # use solveSymmetric to keep track of the factored parameters
+    def factorize (self, matrix):
+        t = instrument.start()
+        self.factorDiagonal = None
+        try:
+            self.factorization = cho_factor(matrix, lower=True, check_finite=False)
+        except np.linalg.LinAlgError:
+            self.factorization = None
+            instrument.count("factorize.notPositiveDefinite")
+        instrument.stop("factorize", t, len(matrix))
+        return self.factorization
+
+    # matrix^-1 rhs with the stored factorization
+    def solveFactorized (self, rhs):
+        return cho_solve(self.factorization, rhs, check_finite=False)
+
+    # parameter-dependent part of the factored matrix A = A0 + W diag(d) W^T, W only depends on geometry
+    # returns d (None: no low-rank updates), columns of W are given by updateBasis
+    def updateDiagonal (self):
+        return None
+
+    # columns of W for the given entries of d (dense, one column per entry)
+    def updateBasis (self, changed):
+        raise Exception("updateBasis is not implemented for " + type(self).__name__)
+
+    # columns of the identity
+    def unitColumns (self, size, indices):
+        columns = np.zeros((size, len(indices)))
+        columns[indices, np.arange(len(indices))] = 1
+        return columns
+
+    # matrix^-1 rhs for a symmetric matrix, None if it is not positive definite
+    # if only a few entries of d (updateDiagonal) changed since the last factorization, the factorization is reused:
+    # A^-1 r = A0^-1 r - A0^-1 U (I + D U^T A0^-1 U)^-1 D U^T A0^-1 r  (U: changed columns of W, D: changes of d)
+    # rows: the factored matrix is restricted to these rows/columns (spanning tree of bond methods)
+    # update=False always refactors (many right-hand sides, e.g. Jacobians)
+    def solveSymmetric (self, matrix, rhs, rows=None, update=True):
+        diagonal = self.updateDiagonal()
+        if update and diagonal is not None and self.factorDiagonal is not None and rows is self.factorRows:
+            changed = np.flatnonzero(diagonal != self.factorDiagonal)
+            if len(changed) == 0:
+                instrument.count("solveSymmetric.reuse")
+                return self.solveFactorized(rhs)
+            if len(changed) <= self.woodburyThreshold * len(diagonal):
+                t = instrument.start()
+                res = self.solveWoodbury(rhs, changed, diagonal[changed] - self.factorDiagonal[changed], rows)
+                if res is not None:
+                    instrument.stop("solveWoodbury", t, len(changed))
+                    instrument.count("solveSymmetric.woodbury")
+                    return res
+
+        instrument.count("solveSymmetric.refactor")
+        if self.factorize(matrix) is None:
+            return None
+        if diagonal is not None:
+            self.factorDiagonal = diagonal.copy()
+            self.factorRows = rows
+        return self.solveFactorized(rhs)
+
+    def solveWoodbury (self, rhs, changed, delta, rows=None):
+        U = self.updateBasis(changed)
+        if rows is not None:
+            U = U[rows]
+        m = 1 if rhs.ndim == 1 else rhs.shape[1]
+        res = self.solveFactorized(np.column_stack((rhs, U)))
+        x, AU = res[:,:m], res[:,m:]
+        capacitance = np.eye(len(changed)) + delta[:,None] * (U.T @ AU)
+        try:
+            correction = AU @ np.linalg.solve(capacitance, delta[:,None] * (U.T @ x))
+        except np.linalg.LinAlgError:
+            return None
+        res = x - correction
+        return res[:,0] if rhs.ndim == 1 else res
+
+    # charge constraint through the Schur complement of the saddle-point system
+    # J q - mu 1 = -chi, 1^T q = netCharge with a = J^-1 (-chi), b = J^-1 1:
+    # q = a + mu b, mu = (netCharge - sum(a)) / sum(b)
+    def constrainedCharges (self, a, b, netCharge):
+        electronegativityEq = (netCharge - np.sum(a)) / np.sum(b)
+        return a + electronegativityEq * b, electronegativityEq
+
+    # dense constrained solve without the augmented matrix: Cholesky of J + Schur complement
+    # returns charges, electronegativityEq; None if J is not positive definite
+    def solveCholesky (self, JMatrix):
+        res = self.solveSymmetric(JMatrix, np.column_stack((-self.electronegativity, np.ones(self.N))))
+        if res is None:
+            return None
+        return self.constrainedCharges(res[:,0], res[:,1], self.netCharge)
+
+    # same, also returns dq/d(-chi) = J^-1 - b b^T / sum(b) (upper-left block of the inverse saddle-point matrix)
+    def solveCholeskyWithResponse (self, JMatrix):
+        N = self.N
+        rhs = np.zeros((N, N + 2))
+        rhs[:,0] = -self.electronegativity
+        rhs[:,1] = 1
+        rhs[:,2:] = np.eye(N)
+        res = self.solveSymmetric(JMatrix, rhs, update=False)
+        if res is None:
+            return None
+        b = res[:,1]
+        charges, electronegativityEq = self.constrainedCharges(res[:,0], b, self.netCharge)
+        G = res[:,2:] - np.outer(b, b) / np.sum(b)
+        return charges, electronegativityEq, G
+
+    # charges for a vector of net charges, q(Q) = a + mu(Q) b
+    # returns K x N charges and K equalized electronegativities; None if J is not positive definite
+    def netChargeScanCholesky (self, JMatrix, netCharges):
+        res = self.solveSymmetric(JMatrix, np.column_stack((-self.electronegativity, np.ones(self.N))))
+        if res is None:
+            return None
+        a, b = res[:,0], res[:,1]
+        electronegativityEq = (netCharges - np.sum(a)) / np.sum(b)
+        return a + np.outer(electronegativityEq, b), electronegativityEq
+
+    # general fallback for indefinite or singular systems: LU, then least squares
+    def solveGeneral (self, X, Y):
+        try:
+            res = np.linalg.solve(X, Y)
+            instrument.count("solveGeneral.lu")
+            return res
+        except np.linalg.LinAlgError:
+            instrument.count("solveGeneral.lstsq")
+            return np.linalg.lstsq(X, Y, rcond=None)[0]
+
+    # J q - mu = -electronegativity, sum(q) = netCharge for sparse J
+    # cg: two Jacobi-preconditioned CG solves and the Schur complement of the charge constraint
+    # minres: the symmetric saddle-point system [J 1; 1^T 0] [q; -mu] = [-electronegativity; netCharge]
+    # convergence is reported in self.solverInfo
+    # returns charges, electronegativityEq
+    def solveSparse (self, JMatrix):
+        N = self.N
+        iterations = [0]
+        def count(xk):
+            iterations[0] += 1
+        diagonal = JMatrix.diagonal()
+        options = dict(rtol=self.krylovTol, maxiter=self.krylovMaxiter, callback=count)
+
+        if self.krylovSolver == "cg":
+            M = diags(1. / diagonal)
+            a, info1 = cg(JMatrix, -self.electronegativity, M=M, **options)
+            b, info2 = cg(JMatrix, np.ones(N), M=M, **options)
+            info = max(info1, info2)
+            charges, electronegativityEq = self.constrainedCharges(a, b, self.netCharge)
+        else:
+            ones = np.ones((N, 1))
+            X = bmat([[JMatrix, ones], [ones.T, None]], format="csr")
+            Y = np.append(-self.electronegativity, self.netCharge)
+            M = diags(np.append(1. / np.abs(diagonal), 1.))
+            res, info = minres(X, Y, M=M, **options)
+            charges = res[:-1]
+            electronegativityEq = -res[-1]
+
+        # residual of the original constrained system
+        residual = np.append(JMatrix @ charges - electronegativityEq + self.electronegativity, np.sum(charges) - self.netCharge)
+        rhsNorm = np.linalg.norm(np.append(self.electronegativity, self.netCharge))
+        self.solverInfo = dict(solver=self.krylovSolver, converged=(info == 0), info=info, iterations=iterations[0], \
+            residual=np.linalg.norm(residual) / rhsNorm, nnz=JMatrix.nnz)
+        instrument.count("solveSparse." + self.krylovSolver)
+        instrument.count("solveSparse.iterations", iterations[0])
+        return charges, electronegativityEq
@@ -2,6 +2,7 @@
 # coding: utf-8
 
 import numpy as np
+from qcalc import instrument
 from qcalc.core.ChargeDistributionMethod import ChargeDistributionMethod
 
 class EEM (ChargeDistributionMethod):
@@ -21,7 +22,7 @@ class EEM (ChargeDistributionMethod):
         self.electronegativity = electronegativity
     
     
-    def solve(self, JMatrix):
+    def system(self, JMatrix):
         # prepare augmented hardness matrix
         N = self.N
         X = np.zeros((N + 1, N + 1))
@@ -34,28 +35,122 @@ class EEM (ChargeDistributionMethod):
         Y = np.zeros(N + 1)
         Y[:-1] = -self.electronegativity
         Y[-1] = self.netCharge
-    
-        # solve system of equations
-        res = np.linalg.solve(X, Y)
+        return X, Y
+
+
+    # same as system, for a stack of K molecules of equal size
+    # JMatrix: K x N x N, electronegativity: K x N, netCharge: K
+    @staticmethod
+    def stackedSystem(JMatrix, electronegativity, netCharge):
+        K, N = electronegativity.shape
+        X = np.zeros((K, N + 1, N + 1))
+        X[:,:-1,:-1] = JMatrix
+        X[:,-1,:-1] = 1
+        X[:,:-1,-1] = -1
+
+        Y = np.zeros((K, N + 1))
+        Y[:,:-1] = -electronegativity
+        Y[:,-1] = netCharge
+        return X, Y
+
+
+    def solve(self, JMatrix):
+        # J is symmetric and usually positive definite: Cholesky + Schur complement
+        res = self.solveCholesky(JMatrix)
+        if res is not None:
+            instrument.count("solve.cholesky")
+            return res
+
+        # otherwise the augmented system
+        instrument.count("solve.augmented")
+        X, Y = self.system(JMatrix)
+        res = self.solveGeneral(X, Y)
         charges = res[:-1]
         electronegativityEq = res[-1]
     
         return charges, electronegativityEq
     
     
+    # hardness on the diagonal of J, for low-rank updates (see solveSymmetric)
+    def updateDiagonal(self):
+        return self.hardness
+
+    def updateBasis(self, changed):
+        return self.unitColumns(self.N, changed)
+    
+    
     # N+1 x N+1 system of equations
     # returns charges, electronegativityEq
     def compute (self):
+        t = instrument.start()
         
-        # atomic J Matrix and Coulomb integrals
-        self.coulomb = self.coulombIntegrals()
-        self.JMatrix = np.diag(self.hardness) + self.coulomb
-        self.charges, self.electronegativityEq = self.solve(self.JMatrix)
+        # atomic J Matrix, Coulomb integrals are cached
+        self.precompute()
+        self.JMatrix = self.addDiagonal(self.coulomb, self.hardness)
+        if self.sparse:
+            self.charges, self.electronegativityEq = self.solveSparse(self.JMatrix)
+        else:
+            self.charges, self.electronegativityEq = self.solve(self.JMatrix)
+        instrument.stop("compute.EEM", t, self.N)
         return self.charges
 
+    # charges and their derivatives w.r.t. electronegativity and hardness
+    # jacobian: N x 2N, columns map to paramsArr via self.jacobianIndices
+    def computeWithJacobian (self):
+        t = instrument.start()
+        
+        if self.sparse:
+            raise Exception("computeWithJacobian is only available in dense mode")
+        self.precompute()
+        self.JMatrix = self.addDiagonal(self.coulomb, self.hardness)
+        res = self.solveCholeskyWithResponse(self.JMatrix)
+        if res is not None:
+            self.charges, self.electronegativityEq, G = res
+        else:
+            # one factorization for the charges and the upper-left block of X^-1
+            X, Y = self.system(self.JMatrix)
+            N = self.N
+            rhs = np.zeros((N + 1, N + 1))
+            rhs[:,0] = Y
+            rhs[:-1,1:] = np.eye(N)
+            res = self.solveGeneral(X, rhs)
+            self.charges = res[:-1,0]
+            self.electronegativityEq = res[-1,0]
+            G = res[:-1,1:]
+        
+        # implicit differentiation of X x = Y
+        self.jacobian = np.hstack((-G, -G * self.charges))
+        instrument.stop("computeWithJacobian.EEM", t, self.N)
+        return self.charges, self.jacobian
+
+    # charges for a vector of K net charges from one factorization
+    # the solution is affine in netCharge: x(Q) = x(0) + Q X^-1 e
+    # returns K x N charges, the equalized electronegativities are stored in self.electronegativityEqScan
+    def computeNetChargeScan (self, netCharges):
+
+        if self.sparse:
+            raise Exception("computeNetChargeScan is only available in dense mode")
+        netCharges = np.atleast_1d(np.asarray(netCharges, dtype=float))
+        self.precompute()
+        self.JMatrix = self.addDiagonal(self.coulomb, self.hardness)
+        res = self.netChargeScanCholesky(self.JMatrix, netCharges)
+        if res is not None:
+            charges, self.electronegativityEqScan = res
+            return charges
+
+        X, Y = self.system(self.JMatrix)
+        Y[-1] = 0
+        e = np.zeros(self.N + 1)
+        e[-1] = 1
+        res = self.solveGeneral(X, np.column_stack((Y, e)))
+        scan = res[:,0] + np.outer(netCharges, res[:,1])
+        self.electronegativityEqScan = scan[:,-1]
+        return scan[:,:-1]
+
     def setIndices(self, indices, ntypes):
         self.elnegIndices = indices
         self.hardnessIndices = indices + ntypes
+        self.jacobianIndices = np.concatenate((self.elnegIndices, self.hardnessIndices))
 
     # for optimization
     def setParams(self, paramsArr):
@@ -2,6 +2,7 @@
 # coding: utf-8
 
 import numpy as np
+from qcalc import instrument
 from qcalc.core.ChargeDistributionMethod import ChargeDistributionMethod
 
 class QEqAtomic (ChargeDistributionMethod):
@@ -21,7 +22,7 @@ class QEqAtomic (ChargeDistributionMethod):
         self.electronegativity = electronegativity
         
    
-    def solve (self, JMatrix):
+    def system (self, JMatrix):
         # prepare hardness matrix
         N = self.N
         X = JMatrix.copy()
@@ -32,27 +33,116 @@ class QEqAtomic (ChargeDistributionMethod):
         Y = -self.electronegativity.copy()
         Y = Y - Y[0]
         Y[0] = self.netCharge
-    
-        # solve system of equations
-        charges = np.linalg.solve(X, Y)
+        return X, Y
+
+
+    # same as system, for a stack of K molecules of equal size
+    # JMatrix: K x N x N, electronegativity: K x N, netCharge: K
+    @staticmethod
+    def stackedSystem (JMatrix, electronegativity, netCharge):
+        X = JMatrix - JMatrix[:,:1,:]
+        X[:,0] = 1
+
+        Y = -electronegativity + electronegativity[:,:1]
+        Y[:,0] = netCharge
+        return X, Y
+
+
+    def solve (self, JMatrix):
+        # subtracting row 0 in system destroys the symmetry of J,
+        # solve the equivalent constrained system with Cholesky + Schur complement if J is positive definite
+        res = self.solveCholesky(JMatrix)
+        if res is not None:
+            instrument.count("solve.cholesky")
+            return res[0]
+
+        instrument.count("solve.augmented")
+        X, Y = self.system(JMatrix)
+        charges = self.solveGeneral(X, Y)
         return charges
 
         
+    # hardness on the diagonal of J, for low-rank updates (see solveSymmetric)
+    def updateDiagonal (self):
+        return self.hardness
+
+    def updateBasis (self, changed):
+        return self.unitColumns(self.N, changed)
+
+        
     # N x N system of equations
     # returns charges
     def compute (self):
+        t = instrument.start()
     
         ## same as for EEM
-        # compute Coulomb integrals
-        self.coulomb = self.coulombIntegrals()
-        self.JMatrix = np.diag(self.hardness) + self.coulomb
-        self.charges = self.solve(self.JMatrix)
+        # Coulomb integrals are cached
+        self.precompute()
+        self.JMatrix = self.addDiagonal(self.coulomb, self.hardness)
+        if self.sparse:
+            self.charges, _ = self.solveSparse(self.JMatrix)
+        else:
+            self.charges = self.solve(self.JMatrix)
     
+        instrument.stop("compute.QEqAtomic", t, self.N)
         return self.charges
 
+    # charges and their derivatives w.r.t. electronegativity and hardness
+    # jacobian: N x 2N, columns map to paramsArr via self.jacobianIndices
+    def computeWithJacobian (self):
+        t = instrument.start()
+
+        if self.sparse:
+            raise Exception("computeWithJacobian is only available in dense mode")
+        self.precompute()
+        self.JMatrix = self.addDiagonal(self.coulomb, self.hardness)
+        res = self.solveCholeskyWithResponse(self.JMatrix)
+        if res is not None:
+            self.charges, _, G = res
+        else:
+            X, Y = self.system(self.JMatrix)
+
+            # P: differences to row 0 as done in system, row 0 holds the constraint
+            N = self.N
+            P = np.eye(N)
+            P[1:,0] = -1
+            P[0] = 0
+
+            # one factorization for the charges and X^-1 P
+            res = self.solveGeneral(X, np.column_stack((Y, P)))
+            self.charges = res[:,0]
+            G = res[:,1:]
+
+        # implicit differentiation of X q = Y
+        self.jacobian = np.hstack((-G, -G * self.charges))
+        instrument.stop("computeWithJacobian.QEqAtomic", t, self.N)
+        return self.charges, self.jacobian
+
+    # charges for a vector of K net charges from one factorization
+    # the solution is affine in netCharge (row 0 of the system): q(Q) = q(0) + Q X^-1 e_0
+    # returns K x N charges
+    def computeNetChargeScan (self, netCharges):
+
+        if self.sparse:
+            raise Exception("computeNetChargeScan is only available in dense mode")
+        netCharges = np.atleast_1d(np.asarray(netCharges, dtype=float))
+        self.precompute()
+        self.JMatrix = self.addDiagonal(self.coulomb, self.hardness)
+        res = self.netChargeScanCholesky(self.JMatrix, netCharges)
+        if res is not None:
+            return res[0]
+
+        X, Y = self.system(self.JMatrix)
+        Y[0] = 0
+        e = np.zeros(self.N)
+        e[0] = 1
+        res = self.solveGeneral(X, np.column_stack((Y, e)))
+        return res[:,0] + np.outer(netCharges, res[:,1])
+
     def setIndices(self, indices, ntypes):
         self.elnegIndices = indices
         self.hardnessIndices = indices + ntypes
+        self.jacobianIndices = np.concatenate((self.elnegIndices, self.hardnessIndices))
 
     # for optimization
     def setParams(self, paramsArr):
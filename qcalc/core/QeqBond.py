@@ -2,6 +2,7 @@
 # coding: utf-8
 
 import numpy as np
+from qcalc import instrument
 from qcalc.core.BondChargeDistributionMethod import BondChargeDistributionMethod
 
 class QEqBond (BondChargeDistributionMethod):
@@ -9,6 +10,9 @@ class QEqBond (BondChargeDistributionMethod):
     # parameter specifications
     paramSpec = ["electronegativity", "hardness"]
     bondParamSpec = []
+
+    # no bond hardness terms: C^T J C only has rank N-1, ring systems are solved on a spanning tree
+    treeReduction = True
     
     def __init__(self, connectivity, distanceMatrix, diameters, hardness, electronegativity, \
             chargeTransferTopology, netCharge=0, maxOrder=1, fpepsi=False):
@@ -22,25 +26,60 @@ class QEqBond (BondChargeDistributionMethod):
         self.electronegativity = electronegativity
             
             
+    # parameter-dependent part of the bond hardness matrix
+    def bondDiagonal(self):
+        return self.calcBondDiagonal(self.hardness, self.bVars)
+
+    def atomicDiagonal(self):
+        return self.hardness
+
+    # same as W diag(hardness) W^T with W = C^T, for low-rank updates (see solveSymmetric)
+    def updateDiagonal(self):
+        return self.hardness
+
+    def updateBasis(self, changed):
+        return self.incidence[changed].toarray().T
+
+            
     def compute(self):
+        t = instrument.start()
             
-        # atomic J Matrix
-        self.coulomb = self.coulombIntegrals()
-        self.JMatrix = np.diag(self.hardness) + self.coulomb
+        # Coulomb integrals, bond variables and the bond-space Coulomb matrix are cached
+        self.precompute()
             
-        # transform to bond variables
-        self.bVars = self.bondVars()
+        # transform to bond variables, only the hardness part changes
         self.bondElneg = self.bondElectronegativity(self.electronegativity, self.bVars)
-        self.bondJMatrix = self.calcBondJMatrix(self.JMatrix, self.bVars)
+        self.bondJMatrix = self.bondCoulomb + self.bondDiagonal()
             
         # solve system
         self.bondCharges = self.solve(self.bondElneg, self.bondJMatrix)
         self.charges = self.toAtomicCharges(self.bondCharges, self.bVars)
+        instrument.stop("compute.QEqBond", t, self.N)
         return self.charges
 
+    # charges and their derivatives w.r.t. electronegativity and hardness
+    # jacobian: N x 2N, columns map to paramsArr via self.jacobianIndices
+    def computeWithJacobian(self):
+        t = instrument.start()
+
+        self.precompute()
+        self.bondElneg = self.bondElectronegativity(self.electronegativity, self.bVars)
+        self.bondJMatrix = self.bondCoulomb + self.bondDiagonal()
+
+        self.bondCharges, bondJInverse = self.solveWithInverse(self.bondElneg, self.bondJMatrix)
+        self.charges = self.toAtomicCharges(self.bondCharges, self.bVars)
+
+        # charge transferred to each atom, scales the hardness derivative
+        transfer = self.charges - self.netCharge / self.N
+        G, _ = self.chargeResponse(bondJInverse, self.bVars)
+        self.jacobian = np.hstack((-G, -G * transfer))
+        instrument.stop("computeWithJacobian.QEqBond", t, self.N)
+        return self.charges, self.jacobian
+
     def setIndices(self, indices, ntypes):
         self.elnegIndices = indices
         self.hardnessIndices = indices + ntypes
+        self.jacobianIndices = np.concatenate((self.elnegIndices, self.hardnessIndices))
 
     # for optimization
     def setParams(self, paramsArr):
@@ -2,6 +2,7 @@
 # coding: utf-8
 
 import numpy as np
+from qcalc import instrument
 from qcalc.core.BondChargeDistributionMethod import BondChargeDistributionMethod
 
 class SQE (BondChargeDistributionMethod):
@@ -28,32 +29,73 @@ class SQE (BondChargeDistributionMethod):
         self.B = len(bondHardness)
         
         
+    # parameter-dependent part of the bond hardness matrix:
+    # transformed atomic hardness scaled by lam^2 and bond hardness on the diagonal, scaled by kappa^2
+    def bondDiagonal (self):
+        scalingFactor1 = self.lam * self.lam
+        scalingFactor2 = self.kappa * self.kappa
+        bondDiagonal = self.calcBondDiagonal(scalingFactor1 * self.hardness, self.bVars)
+        return self.addDiagonal(bondDiagonal, scalingFactor2 * 2 * self.bondHardness)
+
+    # atomic J matrix with diagonal scaled by lam^2
+    def atomicDiagonal (self):
+        return self.lam * self.lam * self.hardness
+
+    # same as W diag(d) W^T with W = [C^T, I] and d = [lam^2 hardness, 2 kappa^2 bondHardness],
+    # for low-rank updates (see solveSymmetric)
+    def updateDiagonal (self):
+        return np.concatenate((self.lam * self.lam * self.hardness, self.kappa * self.kappa * 2 * self.bondHardness))
+
+    def updateBasis (self, changed):
+        atoms = changed[changed < self.N]
+        bonds = changed[changed >= self.N] - self.N
+        return np.hstack((self.incidence[atoms].toarray().T, self.unitColumns(self.B, bonds)))
+
+
     def compute (self):
+        t = instrument.start()
         
-        # atomic J matrix with diagonal scaled by lam^2
-        self.coulomb = self.coulombIntegrals()
-        scalingFactor1 = self.lam * self.lam
-        self.JMatrix = scalingFactor1 * np.diag(self.hardness) + self.coulomb
+        # Coulomb integrals and their bond-space transform are cached
+        self.precompute()
         
-        # transform to bond variables
-        self.bVars = self.bondVars()
+        # transform to bond variables, scaled hardness terms come from bondDiagonal
         self.checkDim(self.bondHardness, self.B)
         self.bondElneg = self.bondElectronegativity(self.electronegativity, self.bVars)
-        self.bondJMatrix = self.calcBondJMatrix(self.JMatrix, self.bVars)
-        
-        # add bond hardness on the diagonal, scaled by kappa^2
-        scalingFactor2 = self.kappa * self.kappa
-        self.bondJMatrix = self.bondJMatrix + scalingFactor2 * 2 * np.diag(self.bondHardness)
+        self.bondJMatrix = self.bondCoulomb + self.bondDiagonal()
         
         # solve system
         self.bondCharges = self.solve(self.bondElneg, self.bondJMatrix)
         self.charges = self.toAtomicCharges(self.bondCharges, self.bVars)
+        instrument.stop("compute.SQE", t, self.N)
         return self.charges
 
+    # charges and their derivatives w.r.t. electronegativity, hardness and bond hardness
+    # jacobian: N x (2N+B), columns map to paramsArr via self.jacobianIndices
+    def computeWithJacobian (self):
+        t = instrument.start()
+
+        self.precompute()
+        scalingFactor1 = self.lam * self.lam
+        scalingFactor2 = self.kappa * self.kappa
+        self.checkDim(self.bondHardness, self.B)
+        self.bondElneg = self.bondElectronegativity(self.electronegativity, self.bVars)
+        self.bondJMatrix = self.bondCoulomb + self.bondDiagonal()
+
+        self.bondCharges, bondJInverse = self.solveWithInverse(self.bondElneg, self.bondJMatrix)
+        self.charges = self.toAtomicCharges(self.bondCharges, self.bVars)
+
+        # charge transferred to each atom, scales the hardness derivative
+        transfer = self.charges - self.netCharge / self.N
+        G, R = self.chargeResponse(bondJInverse, self.bVars)
+        self.jacobian = np.hstack((-G, -G * scalingFactor1 * transfer, -R * scalingFactor2 * 2 * self.bondCharges))
+        instrument.stop("computeWithJacobian.SQE", t, self.N)
+        return self.charges, self.jacobian
+
     def setIndices(self, indices, bondIndices, ntypes):
         self.elnegIndices = indices
         self.hardnessIndices = indices + ntypes
         self.bondHardnessIndices = bondIndices + 2*ntypes
+        self.jacobianIndices = np.concatenate((self.elnegIndices, self.hardnessIndices, self.bondHardnessIndices))
 
     # for optimization
     def setParams(self, paramsArr):
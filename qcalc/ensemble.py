@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import numpy as np
+from rdkit import Chem
+from scipy.spatial import distance_matrix
+
+# thermal energy at 298.15 K in kJ/mol
+KT_298 = 2.479
+
+# normalized Boltzmann weights of conformer energies (same unit as kT)
+def boltzmannWeights(energies, kT=KT_298):
+    energies = np.asarray(energies, dtype=float)
+    w = np.exp(-(energies - np.min(energies)) / kT)
+    return w / np.sum(w)
+
+# K conformers of one molecule
+# topology, types, parameters and bond variables are taken from a single worker (any method),
+# only the K distance and Coulomb matrices are per conformer; all K systems are solved in one batch
+class EnsembleWorker:
+
+    def __init__(self, worker, distanceMatrices):
+        self.worker = worker
+        self.distanceMatrices = np.asarray(distanceMatrices, dtype=float)
+        self.K = len(self.distanceMatrices)
+        for d in self.distanceMatrices:
+            worker.checkDim(d, worker.N)
+
+        # geometry-only quantities of all conformers
+        # the worker's own Coulomb matrix is never used, only the bond topology is precomputed
+        self.coulomb = worker.coulombIntegralsStacked(self.distanceMatrices)
+        self.atomic = hasattr(worker, "stackedSystem")
+        if not self.atomic:
+            worker.precomputeTopology()
+            self.incidence = worker.incidence.toarray()
+            self.bondCoulomb = self.incidence.T @ self.coulomb @ self.incidence
+
+    # for optimization
+    def setParams(self, paramsArr):
+        self.worker.setParams(paramsArr)
+
+    # returns K x N charges
+    def compute(self):
+        w = self.worker
+        K, N = self.K, w.N
+
+        if self.atomic:
+            diagonal = np.arange(N)
+            JMatrix = self.coulomb.copy()
+            JMatrix[:, diagonal, diagonal] += w.hardness
+            electronegativity = np.broadcast_to(w.electronegativity, (K, N))
+            X, Y = w.stackedSystem(JMatrix, electronegativity, np.full(K, w.netCharge, dtype=float))
+            res = np.linalg.solve(X, Y[..., None])[..., 0]
+            self.charges = res[:, :N]
+            return self.charges
+
+        bondJMatrix = self.bondCoulomb + w.bondDiagonal()
+        bondElneg = w.bondElectronegativity(w.electronegativity, w.bVars)
+        # same case distinction as BondChargeDistributionMethod.solve, singular ring systems on the spanning tree
+        if w.treeReduction and w.treeBonds is not None:
+            T = w.treeBonds
+            self.bondCharges = np.zeros((K, w.B))
+            self.bondCharges[:, T] = np.linalg.solve(bondJMatrix[:, T][:, :, T], np.broadcast_to(-bondElneg[T, None], (K, len(T), 1)))[..., 0]
+            # minimum-norm bond charges as in solveTree, the atomic charges do not change
+            self.bondCharges = w.minimumNormBondCharges(self.bondCharges.T).T
+        else:
+            self.bondCharges = np.linalg.solve(bondJMatrix, np.broadcast_to(-bondElneg[:, None], (K, w.B, 1)))[..., 0]
+        self.charges = w.netCharge / N + self.bondCharges @ self.incidence.T
+        return self.charges
+
+    # mean over conformers, or Boltzmann-weighted if conformer energies are given
+    def averageCharges(self, energies=None, kT=KT_298):
+        if energies is None:
+            return np.mean(self.charges, axis=0)
+        return boltzmannWeights(energies, kT) @ self.charges
+
+# ensemble of all conformers of mol for a ChargeModel
+def createEnsemble(mol, model, netCharge=None):
+    m = Chem.RemoveHs(mol)
+    worker = model.createWorker(m, netCharge)
+    distanceMatrices = []
+    for conf in m.GetConformers():
+        positions = 0.1*conf.GetPositions()  # A -> nm
+        distanceMatrices.append(distance_matrix(positions, positions))
+    return EnsembleWorker(worker, np.array(distanceMatrices))
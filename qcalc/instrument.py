@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import json
+import time
+from contextlib import contextmanager
+
+# opt-in instrumentation of the compute path (createWorker, the charge methods, costFunction)
+# hooks record stage timings, call counts and sizes (N atoms or B bonds) and count solver branches
+# disabled (the default), a hook is a function call and a None check
+# stages nest, e.g. "compute.EEM" includes "coulombIntegrals" and "factorize" of that call
+# the recorder is per process: pool processes (createWorkersParallel, runSweep, OptimizationRun) do not report back
+#
+#   with instrument.recording("stats.json") as recorder:
+#       opt = gradientOptimize(...)
+#   recorder.stats()
+
+# current recorder, None if disabled
+_recorder = None
+
+class Recorder:
+
+    def __init__(self):
+        self.stages = dict()
+        self.counters = dict()
+        self.startTime = time.perf_counter()
+
+    def addStage(self, name, elapsed, size=None):
+        stage = self.stages.get(name, None)
+        if stage is None:
+            stage = self.stages[name] = dict(calls=0, total=0., min=float("inf"), max=0., maxSize=0, totalSize=0)
+        stage["calls"] += 1
+        stage["total"] += elapsed
+        stage["min"] = min(stage["min"], elapsed)
+        stage["max"] = max(stage["max"], elapsed)
+        if size is not None:
+            stage["maxSize"] = max(stage["maxSize"], int(size))
+            stage["totalSize"] += int(size)
+
+    def addCount(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    # aggregated stages (calls, total/mean/min/max time in s, max/mean size) and counters as plain dicts
+    def stats(self):
+        stages = dict()
+        for name, stage in self.stages.items():
+            stages[name] = dict(stage, mean=stage["total"] / stage["calls"], meanSize=stage["totalSize"] / stage["calls"])
+        return dict(wallTime=time.perf_counter() - self.startTime, stages=stages, counters=dict(self.counters))
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.stats(), f, indent=1)
+
+    # stages sorted by total time, one line each
+    def summary(self):
+        lines = ["%-32s %8s %10s %10s %8s" % ("stage", "calls", "total (s)", "mean (s)", "maxSize")]
+        stats = self.stats()
+        for name, stage in sorted(stats["stages"].items(), key=lambda item: -item[1]["total"]):
+            lines.append("%-32s %8d %10.4f %10.2e %8d" % (name, stage["calls"], stage["total"], stage["mean"], stage["maxSize"]))
+        for name, n in sorted(stats["counters"].items()):
+            lines.append("%-32s %8d" % (name, n))
+        return "\n".join(lines)
+
+
+# switching on and off
+def enable():
+    global _recorder
+    if _recorder is None:
+        _recorder = Recorder()
+    return _recorder
+
+# returns the recorder that was active
+def disable():
+    global _recorder
+    recorder = _recorder
+    _recorder = None
+    return recorder
+
+def enabled():
+    return _recorder is not None
+
+def reset():
+    global _recorder
+    if _recorder is not None:
+        _recorder = Recorder()
+
+# stats of the active recorder, None if disabled
+def stats():
+    return None if _recorder is None else _recorder.stats()
+
+# fresh recorder for one run, the previous state is restored afterwards
+# path: the stats are also written there as JSON
+@contextmanager
+def recording(path=None):
+    global _recorder
+    previous = _recorder
+    recorder = _recorder = Recorder()
+    try:
+        yield recorder
+    finally:
+        _recorder = previous
+        if path is not None:
+            recorder.save(path)
+
+
+# hooks
+# t = start() ... stop("stage", t, size): start returns None if disabled, stop then does nothing
+def start():
+    if _recorder is None:
+        return None
+    return time.perf_counter()
+
+def stop(name, t, size=None):
+    if t is not None and _recorder is not None:
+        _recorder.addStage(name, time.perf_counter() - t, size)
+
+def count(name, n=1):
+    if _recorder is not None:
+        _recorder.addCount(name, n)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from qcalc import workers
+from qcalc.workers import createParameters, prepareMolecule
+
+# charge model for inference, built once and applied to many molecules
+# parameter tables and typing setup are resolved in the constructor,
+# a call only does the per-molecule work (typing, geometry, solve)
+# the model is never modified after construction, so it can be shared between threads
+class ChargeModel:
+
+    def __init__(self, paramTable, method, atomTypeFunc, bondTypeFunc=None, bondParamTable=None, **kwargs):
+        self.method = method
+        self.atomTypeFunc = atomTypeFunc
+        self.bondTypeFunc = bondTypeFunc
+        self.netCharge = kwargs.get("netCharge", 0)
+        self.maxOrder = kwargs.get("maxOrder", 1)
+        self.sparse = kwargs.get("sparse", False)
+        self.cutoff = kwargs.get("cutoff", None)
+        # worker options, passed on to workers.createWorkerFromData
+        self.options = {k: v for k, v in kwargs.items() if k in ["maxOrder", "fpepsi", "kappa", "lam", "sparse", "cutoff", \
+            "krylovSolver", "krylovTol", "krylovMaxiter"]}
+
+        # snapshot of the tables, later changes by the caller do not leak in
+        self.params, self.bondParams = createParameters(paramTable, method, bondParamTable=bondParamTable)
+        self.bondMethod = method in ["AACT", "SQE"]
+        if self.bondMethod and bondTypeFunc is None:
+            raise Exception("bondTypeFunc is required for AACT and SQE")
+
+        # resolve all lookup tables now, calls only read them
+        self.params.typeIndex("atom")
+        for prop in ["electronegativity", "hardness", "diameter"]:
+            self.params.column(prop)
+        if self.bondMethod:
+            self.bondParams.typeIndex("type")
+            for prop in ["electronegativity", "hardness"]:
+                self.bondParams.column(prop)
+
+    # molData: output of prepareMolecule
+    def createWorkerFromData(self, molData, netCharge=None):
+        if netCharge is None:
+            netCharge = self.netCharge
+        return workers.createWorkerFromData(molData, self.params, self.method, bondParams=self.bondParams, \
+            netCharge=netCharge, **self.options)
+
+    def createWorker(self, mol, netCharge=None):
+        molData = prepareMolecule(mol, self.atomTypeFunc, self.bondTypeFunc if self.bondMethod else None, max(self.maxOrder, 1), \
+            self.sparse, self.cutoff if self.sparse else None)
+        return self.createWorkerFromData(molData, netCharge)
+
+    # charges of one molecule for several net charges (e.g. protonation states), K x N
+    def netChargeScan(self, mol, netCharges):
+        return self.createWorker(mol).computeNetChargeScan(netCharges)
+
+    # charges of one molecule
+    def __call__(self, mol, netCharge=None):
+        return self.createWorker(mol, netCharge).compute()
@@ -1,8 +1,13 @@
-from qcalc.workers import createWorker, createParameters
-from qcalc.parameter import Parameter
-from scipy.optimize import dual_annealing, basinhopping, shgo
+from qcalc.workers import createWorker, createWorkerFromData, createParameters
+from qcalc.parameter import Parameter, ParameterVector
+from qcalc.cache import readMolecule
+from rdkit import Chem
+from qcalc import instrument
+from scipy.optimize import dual_annealing, basinhopping, shgo, minimize, least_squares, OptimizeResult
 import numpy as np
 import pandas as pd
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 
 
 def calculateWeights(atomTypes, params):
@@ -15,16 +20,29 @@ def calculateWeights(atomTypes, params):
     weights = {k:v for k,v in list(zip(params.df["atom"], wcol))}
     return weights
 
+# full parameter array from the free parameters
+# constr is either the (indices, values) tuple of createParamsArr or a ParameterVector,
+# which is written in place instead of reallocated
+# returns the full array and the positions of the free parameters in it
+def expandParams(arr, constr):
+    if isinstance(constr, ParameterVector):
+        return constr.set(arr), constr.freeIndices
+    paramsArr = np.insert(arr, constr[0], constr[1])
+    free = np.insert(np.ones(len(arr), dtype=bool), constr[0], False)
+    return paramsArr, free
+
 # weights is a dict {atomType: weight}
 # targetCharges is array of arrays
 def costFunction(arr, workers, weights, targetCharges, constr):
+    t = instrument.start()
     
     # add constrained values
-    paramsArr = np.insert(arr, constr[0], constr[1])
+    paramsArr, _ = expandParams(arr, constr)
 
     # update parameters
     for worker in workers:
         worker.setParams(paramsArr)
+    instrument.stop("costFunction.setParams", t, len(workers))
 
     totalCost = 0
 
@@ -34,8 +52,221 @@ def costFunction(arr, workers, weights, targetCharges, constr):
         w = np.array([weights[a] for a in worker.atomTypes])
         totalCost += np.sum(w*(charges - target)**2)
 
+    instrument.stop("costFunction", t, len(workers))
     return totalCost
 
+# same as costFunction, also returns the gradient w.r.t. arr
+# uses the analytic charge derivatives of the workers
+def costFunctionWithGradient(arr, workers, weights, targetCharges, constr):
+    t = instrument.start()
+
+    # add constrained values
+    paramsArr, free = expandParams(arr, constr)
+
+    # update parameters
+    for worker in workers:
+        worker.setParams(paramsArr)
+    instrument.stop("costFunctionWithGradient.setParams", t, len(workers))
+
+    totalCost = 0
+    gradient = np.zeros(len(paramsArr))
+
+    # compute charges and their derivatives
+    for worker, target in list(zip(workers, targetCharges)):
+        charges, jacobian = worker.computeWithJacobian()
+        w = np.array([weights[a] for a in worker.atomTypes])
+        residual = charges - target
+        totalCost += np.sum(w*residual**2)
+        np.add.at(gradient, worker.jacobianIndices, jacobian.T @ (2*w*residual))
+
+    instrument.stop("costFunctionWithGradient", t, len(workers))
+    # constrained values are not optimized
+    return totalCost, gradient[free]
+
+# local gradient-based fit, e.g. L-BFGS-B, TNC or trust-constr
+# bounds is a list of (min, max) tuples like the ranges for the global optimizers
+def gradientOptimize(paramsArr, workers, weights, targetCharges, constr, bounds=None, method="L-BFGS-B", **options):
+    opt = minimize(costFunctionWithGradient, paramsArr, args=(workers, weights, targetCharges, constr), \
+        jac=True, method=method, bounds=bounds, options=options)
+    return opt
+
+# same as costFunction, with the workers wrapped in a BatchSolver
+def batchCostFunction(arr, batch, weights, targetCharges, constr):
+
+    # add constrained values
+    paramsArr, _ = expandParams(arr, constr)
+
+    # update parameters and compute all charges at once
+    batch.setParams(paramsArr)
+    allCharges = batch.compute()
+
+    totalCost = 0
+    for worker, charges, target in list(zip(batch.workers, allCharges, targetCharges)):
+        w = np.array([weights[a] for a in worker.atomTypes])
+        totalCost += np.sum(w*(charges - target)**2)
+
+    return totalCost
+
+# weighted residuals sqrt(w) (q - target) of all molecules as one flat vector
+# targets and per-atom weights are flattened once, every evaluation only writes charges into a preallocated buffer
+# the sum of squares is the same cost as costFunction
+# molecules: indices of a subset of the workers (mini-batch), None for all
+class ResidualObjective:
+
+    def __init__(self, workers, weights, targetCharges, constr):
+        self.workers = workers
+        self.constr = constr
+        self.offsets = np.concatenate(([0], np.cumsum([w.N for w in workers])))
+        self.targets = np.concatenate([np.asarray(t, dtype=float) for t in targetCharges])
+        self.sqrtWeights = np.sqrt(np.concatenate([[weights[a] for a in w.atomTypes] for w in workers]))
+        self.charges = np.zeros(len(self.targets))
+
+        # analytic derivatives are available for all dense workers, otherwise finite differences
+        self.analyticJacobian = all(hasattr(w, "jacobianIndices") and not w.sparse for w in workers)
+
+    # positions of the atoms of a subset in the flat arrays
+    def rows(self, molecules):
+        if molecules is None:
+            return slice(None)
+        return np.concatenate([np.arange(self.offsets[k], self.offsets[k + 1]) for k in molecules])
+
+    def setParams(self, arr, molecules=None):
+        paramsArr, free = expandParams(arr, self.constr)
+        for k in range(len(self.workers)) if molecules is None else molecules:
+            self.workers[k].setParams(paramsArr)
+        return paramsArr, free
+
+    # residual vector (total number of atoms)
+    def residuals(self, arr, molecules=None):
+        self.setParams(arr, molecules)
+        for k in range(len(self.workers)) if molecules is None else molecules:
+            self.charges[self.offsets[k]:self.offsets[k + 1]] = self.workers[k].compute()
+        rows = self.rows(molecules)
+        return self.sqrtWeights[rows] * (self.charges[rows] - self.targets[rows])
+
+    # scalar cost, drop-in for costFunction
+    def __call__(self, arr, molecules=None):
+        residuals = self.residuals(arr, molecules)
+        return residuals @ residuals
+
+    # derivatives of the residuals w.r.t. the free parameters (atoms x free parameters)
+    def jacobian(self, arr, molecules=None):
+        paramsArr, free = self.setParams(arr, molecules)
+        rows = self.rows(molecules)
+        molecules = range(len(self.workers)) if molecules is None else molecules
+        jacobian = np.zeros((len(self.targets[rows]), len(paramsArr)))
+        start = 0
+        for k in molecules:
+            worker = self.workers[k]
+            charges, workerJacobian = worker.computeWithJacobian()
+            self.charges[self.offsets[k]:self.offsets[k + 1]] = charges
+            np.add.at(jacobian, (slice(start, start + worker.N), worker.jacobianIndices), workerJacobian)
+            start += worker.N
+        return self.sqrtWeights[rows,None] * jacobian[:,free]
+
+    # drop-in for costFunctionWithGradient
+    def withGradient(self, arr, molecules=None):
+        jacobian = self.jacobian(arr, molecules)
+        rows = self.rows(molecules)
+        residuals = self.sqrtWeights[rows] * (self.charges[rows] - self.targets[rows])
+        return residuals @ residuals, 2 * jacobian.T @ residuals
+
+# mini-batches of molecules, stratified by atom type:
+# every batch first takes one random molecule for each atom type (rarest first, skipped if already covered),
+# the rest of the batch is drawn uniformly from the remaining molecules
+class StratifiedSampler:
+
+    def __init__(self, workers, batchSize, seed=None):
+        self.nMolecules = len(workers)
+        self.batchSize = min(batchSize, self.nMolecules)
+        self.rng = np.random.default_rng(seed)
+
+        # molecules containing each atom type, rarest type first
+        byType = dict()
+        for k, worker in enumerate(workers):
+            for a in set(worker.atomTypes):
+                byType.setdefault(a, []).append(k)
+        self.strata = sorted(((a, np.array(m)) for a, m in byType.items()), key=lambda item: len(item[1]))
+        self.moleculeTypes = [set(worker.atomTypes) for worker in workers]
+
+    # sorted molecule indices
+    def sample(self):
+        chosen = set()
+        covered = set()
+        for atomType, molecules in self.strata:
+            if len(chosen) >= self.batchSize:
+                break
+            if atomType in covered:
+                continue
+            k = int(self.rng.choice(molecules))
+            chosen.add(k)
+            covered |= self.moleculeTypes[k]
+        while len(chosen) < self.batchSize:
+            chosen.add(int(self.rng.integers(self.nMolecules)))
+        return np.array(sorted(chosen))
+
+# stochastic fit on mini-batches (Adam), followed by full-batch refinement
+# schedule: list of (steps, batchSize, learningRate) stages; the learning rate is relative to the parameter magnitude
+# the mini-batch cost is scaled to the size of the full training set
+# refine: "least_squares", "gradient" or None, refineOptions are passed on to the refinement
+# bounds is a list of (min, max) tuples like the ranges for the global optimizers
+def stochasticOptimize(paramsArr, objective, schedule=((200, 32, 0.01),), bounds=None, refine="least_squares", refineOptions=None, \
+        seed=None, callback=None):
+    if not objective.analyticJacobian:
+        raise Exception("stochasticOptimize needs analytic derivatives (dense workers)")
+    x = np.array(paramsArr, dtype=float)
+    scale = np.maximum(np.abs(x), 1e-3)
+    if bounds is not None:
+        lower = np.array([b[0] for b in bounds])
+        upper = np.array([b[1] for b in bounds])
+
+    # Adam moments
+    beta1, beta2, eps = 0.9, 0.999, 1e-8
+    m = np.zeros(len(x))
+    v = np.zeros(len(x))
+    t = 0
+    history = []
+    rng = np.random.default_rng(seed)
+    for steps, batchSize, learningRate in schedule:
+        sampler = StratifiedSampler(objective.workers, batchSize, rng)
+        for step in range(steps):
+            batch = sampler.sample()
+            cost, gradient = objective.withGradient(x, batch)
+            factor = len(objective.workers) / len(batch)
+            g = factor * gradient * scale
+            t += 1
+            m = beta1 * m + (1 - beta1) * g
+            v = beta2 * v + (1 - beta2) * g**2
+            x = x - learningRate * scale * (m / (1 - beta1**t)) / (np.sqrt(v / (1 - beta2**t)) + eps)
+            if bounds is not None:
+                x = np.clip(x, lower, upper)
+            history.append(factor * cost)
+            if callback is not None:
+                callback(x, factor * cost)
+
+    refineOptions = refineOptions or {}
+    if refine == "least_squares":
+        opt = leastSquaresOptimize(x, objective, bounds, **refineOptions)
+    elif refine == "gradient":
+        opt = minimize(objective.withGradient, x, jac=True, method="L-BFGS-B", bounds=bounds, options=refineOptions)
+    elif refine is None:
+        opt = OptimizeResult(x=x, fun=objective(x), success=True, nit=t)
+    else:
+        raise Exception("refine " + refine + " is undefined")
+    opt.history = history
+    return opt
+
+# fit with scipy.optimize.least_squares on the residual vector (trf, dogbox or lm)
+# bounds is a list of (min, max) tuples like the ranges for the global optimizers
+def leastSquaresOptimize(paramsArr, objective, bounds=None, method="trf", **options):
+    jac = objective.jacobian if objective.analyticJacobian else "2-point"
+    if bounds is None:
+        bounds = (-np.inf, np.inf)
+    else:
+        bounds = (np.array([b[0] for b in bounds]), np.array([b[1] for b in bounds]))
+    opt = least_squares(objective.residuals, paramsArr, jac=jac, bounds=bounds, method=method, **options)
+    return opt
+
 def createParamsArr(params, bondParams):
     paramsArr, constr = params.toArray()
     if bondParams is not None:
@@ -49,27 +280,89 @@ def createParamsArr(params, bondParams):
         paramsArr = np.concatenate((paramsArr, bondParamsArr), axis=0)
     return paramsArr, constr
 
-def updateParams(params, bondParams, paramsArr):
-    lenParams = params.M * params.N - len(params.constraints)
-    params.update(paramsArr[:lenParams])
-    if (bondParams is not None) and len(paramsArr[lenParams:]) > 0:
-        bondParams.update(paramsArr[lenParams:])
+# free parameters (createParamsArr layout) into the parameter tables
+# vector: the ParameterVector of the fit, built from the tables otherwise
+def updateParams(params, bondParams, paramsArr, vector=None):
+    if vector is None:
+        vector = ParameterVector(params, bondParams)
+    vector.set(paramsArr)
+    vector.writeBack()
 
+# mols can be RDKit molecules or molData dicts (prepareMolecule, MoleculeCache)
 def createWorkers(mols, params, method, atomTypeFunc, bondParams, **kwargs):
     workers = []
     for mol in mols:
-        worker = createWorker(mol, params, method, atomTypeFunc, bondParams=bondParams, **kwargs)
+        if isinstance(mol, dict):
+            worker = createWorkerFromData(mol, params, method, bondParams=bondParams, **kwargs)
+        else:
+            worker = createWorker(mol, params, method, atomTypeFunc, bondParams=bondParams, **kwargs)
         workers.append(worker)
     return workers 
 
 
+# RDKit pickles coordinates in single precision, molecules go to the pool as binaries with double coordinates
+_PICKLE_OPTIONS = Chem.PropertyPickleOptions.AllProps | Chem.PropertyPickleOptions.CoordsAsDouble
+
+# build and precompute one worker, runs in the process pool
+# mol can be an RDKit binary (bytes), a molData dict or the path of a mol/SDF file
+# returns (worker, None) or (None, error message)
+def _buildWorker(mol, params, method, atomTypeFunc, bondParams, kwargs):
+    try:
+        targetCharges = None
+        if isinstance(mol, bytes):
+            mol = Chem.Mol(mol)
+        if isinstance(mol, str):
+            mol = readMolecule(mol, atomTypeFunc, kwargs.get("bondTypeFunc", None))
+            targetCharges = mol.get("targetCharges", None)
+        if isinstance(mol, dict):
+            worker = createWorkerFromData(mol, params, method, bondParams=bondParams, **kwargs)
+        else:
+            worker = createWorker(mol, params, method, atomTypeFunc, bondParams=bondParams, **kwargs)
+        if targetCharges is not None:
+            worker.targetCharges = targetCharges
+        worker.precompute()
+        return worker, None
+    except Exception as e:
+        return None, repr(e)
+
+# one chunk of molecules, runs in the process pool
+def _buildChunk(mols, build):
+    return [build(mol) for mol in mols]
+
+# same as createWorkers, spread over a process pool
+# workers only hold numpy/scipy arrays, so they are sent back to the parent as they are
+# atomTypeFunc and bondTypeFunc must be picklable (defined at module level)
+# returns workers in input order (None where construction failed) and a list of (index, error message)
+def createWorkersParallel(mols, params, method, atomTypeFunc, bondParams, nprocs=None, chunksize=8, **kwargs):
+    build = partial(_buildWorker, params=params, method=method, atomTypeFunc=atomTypeFunc, bondParams=bondParams, kwargs=kwargs)
+    tasks = [mol.ToBinary(_PICKLE_OPTIONS) if isinstance(mol, Chem.Mol) else mol for mol in mols]
+    chunks = [range(k, min(k + chunksize, len(tasks))) for k in range(0, len(tasks), chunksize)]
+    results = []
+    with ProcessPoolExecutor(max_workers=nprocs) as pool:
+        futures = [pool.submit(_buildChunk, [tasks[k] for k in chunk], build) for chunk in chunks]
+        for chunk, future in zip(chunks, futures):
+            try:
+                results += future.result()
+            except Exception:
+                # a worker which cannot be sent back fails its whole chunk, retry the molecules one by one
+                for k in chunk:
+                    try:
+                        results.append(pool.submit(build, tasks[k]).result())
+                    except Exception as e:
+                        results.append((None, repr(e)))
+    workers = [worker for worker, _ in results]
+    failures = [(k, error) for k, (_, error) in enumerate(results) if error is not None]
+    return workers, failures
+
 # mols - list
 # targetCharges - list of lists
 def optimizeParameters(mols, paramTable, method, atomTypeFunc, targetCharges, **kwargs):
 
     # prepare parameters
     params, bondParams = createParameters(paramTable, method, **kwargs)
-    paramsArr, constr = createParamsArr(params, bondParams)
+    # constrained values stay in the buffer, every evaluation only writes the free parameters
+    constr = ParameterVector(params, bondParams)
+    paramsArr = constr.free()
 
     # prepare workers
     workers = createWorkers(mols, params, method, atomTypeFunc, bondParams, **kwargs)
@@ -81,6 +374,26 @@ def optimizeParameters(mols, paramTable, method, atomTypeFunc, targetCharges, **
     # parameter ranges - [0, 10*initial params]
     ranges = [(1E-3,10*p) for p in paramsArr]
 
+    # fit="least_squares", "gradient" or "stochastic" runs a fit on the flat residual objective
+    # and returns the updated parameter tables together with the scipy result
+    # the stochastic fit takes schedule, refine and seed (see stochasticOptimize)
+    fit = kwargs.get("fit", None)
+    if fit is not None:
+        objective = ResidualObjective(workers, weights, targetCharges, constr)
+        bounds = ranges if kwargs.get("bounded", True) else None
+        if fit == "least_squares":
+            opt = leastSquaresOptimize(paramsArr, objective, bounds, **kwargs.get("fitOptions", {}))
+        elif fit == "gradient":
+            opt = minimize(objective.withGradient, paramsArr, jac=True, method="L-BFGS-B", bounds=bounds, \
+                options=kwargs.get("fitOptions", {}))
+        elif fit == "stochastic":
+            opt = stochasticOptimize(paramsArr, objective, kwargs.get("schedule", ((200, 32, 0.01),)), bounds, \
+                kwargs.get("refine", "least_squares"), kwargs.get("fitOptions", {}), kwargs.get("seed", None))
+        else:
+            raise Exception("fit " + fit + " is undefined")
+        updateParams(params, bondParams, opt.x, constr)
+        return params, bondParams, opt
+
     # run optimization
     #maxiter = kwargs.get("maxiter", 1000)
     #opt = dual_annealing(costFunction, ranges, args=(workers, weights, targetCharges, constr), maxiter=maxiter)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from qcalc.optimize import expandParams
+
+# dense geometry-only arrays of a precomputed worker, moved to shared memory
+GEOMETRY_ATTRIBUTES = ["connectivity", "distanceMatrix", "coulomb", "bondCoulomb"]
+
+# long-lived process owning a shard of workers
+# receives full parameter arrays, returns per-molecule costs (and gradient contributions)
+def _shardLoop(conn, shmName, workers, layouts, weights, targetCharges):
+    shm = shared_memory.SharedMemory(name=shmName)
+    buffer = np.ndarray((shm.size // 8,), dtype=np.float64, buffer=shm.buf)
+    for worker, layout in zip(workers, layouts):
+        for attr, (offset, shape) in layout.items():
+            setattr(worker, attr, buffer[offset:offset + int(np.prod(shape))].reshape(shape))
+
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        task, paramsArr = message
+        results = []
+        for worker, w, target in zip(workers, weights, targetCharges):
+            worker.setParams(paramsArr)
+            if task == "gradient":
+                charges, jacobian = worker.computeWithJacobian()
+                residual = charges - target
+                results.append((np.sum(w*residual**2), jacobian.T @ (2*w*residual)))
+            else:
+                charges = worker.compute()
+                results.append(np.sum(w*(charges - target)**2))
+        conn.send(results)
+
+    # release the views before closing the shared block
+    del workers, buffer
+    shm.close()
+    conn.close()
+
+
+# costFunction evaluated by persistent processes, each owning a contiguous shard of the workers
+# geometry (Coulomb matrices etc.) is copied once into shared memory; every evaluation only
+# sends the parameter array and collects per-molecule costs, which are summed in the serial order
+# so the result is identical to costFunction
+# use as a context manager or call close() when done
+class ParallelCostFunction:
+
+    def __init__(self, workers, weights, targetCharges, constr, nprocs=None):
+        self.constr = constr
+        self.nMolecules = len(workers)
+        self.jacobianIndices = [getattr(w, "jacobianIndices", None) for w in workers]
+        nprocs = min(nprocs or mp.cpu_count(), len(workers))
+
+        # geometry of all workers in one shared block
+        layouts = []
+        size = 0
+        for worker in workers:
+            worker.precompute()
+            layout = dict()
+            for attr in GEOMETRY_ATTRIBUTES:
+                value = getattr(worker, attr, None)
+                if isinstance(value, np.ndarray):
+                    layout[attr] = (size, value.shape)
+                    size += value.size
+            layouts.append(layout)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(8 * size, 8))
+        buffer = np.ndarray((size,), dtype=np.float64, buffer=self.shm.buf)
+        for worker, layout in zip(workers, layouts):
+            for attr, (offset, shape) in layout.items():
+                buffer[offset:offset + int(np.prod(shape))] = getattr(worker, attr).ravel()
+        del buffer
+
+        # contiguous shards with roughly equal solve cost (N^3)
+        work = np.cumsum([float(w.N)**3 for w in workers])
+        bounds = np.searchsorted(work, work[-1] * np.arange(1, nprocs) / nprocs)
+        shards = np.split(np.arange(len(workers)), bounds)
+
+        # send workers without their geometry, it is attached from shared memory
+        self.connections = []
+        self.processes = []
+        for shard in shards:
+            if len(shard) == 0:
+                continue
+            shardWorkers = []
+            for k in shard:
+                stripped = object.__new__(type(workers[k]))
+                stripped.__dict__.update(workers[k].__dict__)
+                for attr in layouts[k]:
+                    setattr(stripped, attr, None)
+                shardWorkers.append(stripped)
+            shardWeights = [np.array([weights[a] for a in workers[k].atomTypes]) for k in shard]
+            shardTargets = [targetCharges[k] for k in shard]
+            parentConn, childConn = mp.Pipe()
+            process = mp.Process(target=_shardLoop, args=(childConn, self.shm.name, shardWorkers, \
+                [layouts[k] for k in shard], shardWeights, shardTargets), daemon=True)
+            process.start()
+            childConn.close()
+            self.connections.append(parentConn)
+            self.processes.append(process)
+
+    def gather(self, task, paramsArr):
+        for conn in self.connections:
+            conn.send((task, paramsArr))
+        results = []
+        for conn in self.connections:
+            results += conn.recv()
+        return results
+
+    def __call__(self, arr):
+        paramsArr, _ = expandParams(arr, self.constr)
+        totalCost = 0
+        for cost in self.gather("cost", paramsArr):
+            totalCost += cost
+        return totalCost
+
+    # same as costFunctionWithGradient
+    def withGradient(self, arr):
+        paramsArr, free = expandParams(arr, self.constr)
+        totalCost = 0
+        gradient = np.zeros(len(paramsArr))
+        for indices, (cost, localGradient) in zip(self.jacobianIndices, self.gather("gradient", paramsArr)):
+            totalCost += cost
+            np.add.at(gradient, indices, localGradient)
+        return totalCost, gradient[free]
+
+    def close(self):
+        for conn in self.connections:
+            conn.send(None)
+            conn.close()
+        for process in self.processes:
+            process.join()
+        self.connections = []
+        self.processes = []
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -6,8 +6,9 @@ import pandas as pd
 
 class Parameter:
 
-    def __init__(self, df):
-        self.df = df.copy()
+    # copy=False shares the table with the caller, only use it if the parameters are never updated
+    def __init__(self, df, copy=True):
+        self.df = df.copy() if copy else df
         self.N = df.shape[0]
 
         self.hardnessLabel = "hardness"
@@ -17,6 +18,31 @@ class Parameter:
         self.diameterLabel = 'diameters'
         self.constraints = []
 
+        # lookup tables, filled on first use (see refresh)
+        self.rowIndex = dict()
+        self.columns = dict()
+
+    # drop lookup tables, needed after editing self.df directly
+    def refresh(self):
+        self.rowIndex = dict()
+        self.columns = dict()
+
+    # type -> row dictionary for one label column
+    # the first row wins for duplicate types
+    def typeIndex(self, typeLabel):
+        if typeLabel not in self.rowIndex:
+            index = dict()
+            for row, t in enumerate(self.df[typeLabel]):
+                index.setdefault(t, row)
+            self.rowIndex[typeLabel] = index
+        return self.rowIndex[typeLabel]
+
+    # contiguous numpy array of one column
+    def column(self, prop):
+        if prop not in self.columns:
+            self.columns[prop] = np.ascontiguousarray(self.df[prop].to_numpy(dtype=float))
+        return self.columns[prop]
+
     def setParamSpec(self, paramSpec):
         self.paramSpec = paramSpec
         self.M = len(paramSpec)
@@ -28,20 +54,31 @@ class Parameter:
         self.constraints.append((self.N * propIndex + atomIndex, value))
         
 
+    # one dictionary lookup per distinct type
     def extractRows(self, types, typeLabel):
-        rows = np.array([self.df.index[self.df[typeLabel] == a][0] for a in types])
+        index = self.typeIndex(typeLabel)
+        try:
+            uniqueTypes, inverse = np.unique(np.asarray(types), return_inverse=True)
+        except TypeError:
+            # types which cannot be sorted (e.g. None from a typing function), look up one by one
+            uniqueTypes, inverse = list(types), np.arange(len(types))
+        try:
+            uniqueRows = np.array([index[t] for t in uniqueTypes], dtype=int)
+        except KeyError as e:
+            raise Exception("type " + str(e.args[0]) + " not found in column " + typeLabel)
+        rows = uniqueRows[inverse.ravel()]
         return rows
 
     def extractProp(self, types, typeLabel, prop):
         rows = self.extractRows(types, typeLabel)
-        col = self.df.iloc[rows,:][prop]
-        return np.array(col)
+        return self.column(prop)[rows]
+
+    # all columns in paramSpec, one after another
+    def fullArray(self):
+        return np.concatenate([self.column(colName) for colName in self.paramSpec])
 
     def toArray(self):
-        arr = np.array([])
-        for colName in self.paramSpec:
-            col = self.df[colName].to_numpy()
-            arr = np.concatenate((arr, col), axis=0)
+        arr = self.fullArray()
         # add constraints
         constrIndices = [c[0] for c in self.constraints]
         constrValues = [c[1] for c in self.constraints]
@@ -57,15 +94,60 @@ class Parameter:
         return indices
 
     def update(self, constrArr):
-        # add constrained values
-        constrIndices = np.array([c[0] for c in self.constraints], dtype="int")
-        constrValues = np.array([c[1] for c in self.constraints])
-        mask = np.arange(0,len(constrIndices))
-        updConstrIndices = constrIndices - mask
-        arr = np.insert(constrArr, updConstrIndices, constrValues)
-        # update df
-        start = 0
-        for colName in self.paramSpec:
-            col = arr[start:start+self.N]
-            self.df[colName] = col
-            start += self.N
+        # constrained values at their positions, free values in between
+        arr = np.empty(self.M * self.N)
+        free = np.ones(len(arr), dtype=bool)
+        free[[c[0] for c in self.constraints]] = False
+        arr[free] = constrArr
+        arr[~free] = [c[1] for c in self.constraints]
+        self.setFullArray(arr)
+
+    # inverse of fullArray: all columns in paramSpec in one write
+    # the type lookup tables stay valid, the column cache is replaced by the new values
+    def setFullArray(self, arr):
+        values = np.asarray(arr, dtype=float).reshape(self.M, self.N)
+        self.df[self.paramSpec] = values.T
+        for colName, col in zip(self.paramSpec, values):
+            self.columns[colName] = np.ascontiguousarray(col)
+
+
+# flat parameter vector for optimization
+# atomic and bond parameters live in one preallocated buffer in the layout the workers index
+# (paramsArr of createParamsArr with constrained values inserted), workers gather their entries
+# from it with their index arrays (setParams)
+# the optimizer only writes the free entries, in place; the free entries are ordered as in createParamsArr
+class ParameterVector:
+
+    def __init__(self, params, bondParams=None):
+        self.tables = [params] if bondParams is None else [params, bondParams]
+        self.values = np.concatenate([p.fullArray() for p in self.tables])
+
+        # positions of constrained entries in the buffer
+        constrained = []
+        self.offsets = [0]
+        for p in self.tables:
+            constrained += [self.offsets[-1] + c[0] for c in p.constraints]
+            self.offsets.append(self.offsets[-1] + p.M * p.N)
+        free = np.ones(len(self.values), dtype=bool)
+        free[constrained] = False
+        self.freeIndices = np.flatnonzero(free)
+        self.constrainedIndices = np.flatnonzero(~free)
+        self.nFree = len(self.freeIndices)
+
+        # without constraints the free parameters are a plain view
+        if len(self.constrainedIndices) == 0:
+            self.freeIndices = slice(None)
+
+    # current values of the free parameters (initial guess for optimizers)
+    def free(self):
+        return self.values[self.freeIndices].copy()
+
+    # write free parameters in place, returns the full buffer
+    def set(self, arr):
+        self.values[self.freeIndices] = arr
+        return self.values
+
+    # current buffer into the parameter tables
+    def writeBack(self):
+        for p, start, stop in zip(self.tables, self.offsets[:-1], self.offsets[1:]):
+            p.setFullArray(self.values[start:stop])
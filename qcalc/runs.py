@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import sys
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from scipy.optimize import differential_evolution, minimize, OptimizeResult
+
+# objective of the current process, set once per pool process by the initializer
+_objective = None
+
+def _initObjective(objective):
+    global _objective
+    _objective = objective
+
+def _evaluate(x):
+    return _objective(x), time.time()
+
+# local search from x0 in a pool process, returns the result and all evaluations (wall time, cost, x)
+def _localSearch(x0, bounds, method, options):
+    trace = []
+    if getattr(_objective, "analyticJacobian", False):
+        def fun(x):
+            cost, gradient = _objective.withGradient(x)
+            trace.append((time.time(), cost, np.array(x)))
+            return cost, gradient
+        opt = minimize(fun, x0, jac=True, method=method, bounds=bounds, options=options)
+    else:
+        def fun(x):
+            cost = _objective(x)
+            trace.append((time.time(), cost, np.array(x)))
+            return cost
+        opt = minimize(fun, x0, method=method, bounds=bounds, options=options)
+    return OptimizeResult(x=opt.x, fun=opt.fun, nfev=opt.nfev, success=opt.success), trace
+
+
+# append-only log of all evaluations
+# one float64 record per evaluation: wall time (s since epoch), cost, parameters
+class EvaluationLog:
+
+    def __init__(self, path, nParams):
+        self.path = path
+        self.nParams = nParams
+
+    def append(self, wallTimes, costs, X):
+        records = np.column_stack((wallTimes, costs, np.reshape(X, (len(costs), self.nParams))))
+        with open(self.path, "ab") as f:
+            f.write(records.astype(np.float64).tobytes())
+
+    # returns wall times, costs and parameters (evaluations x parameters)
+    def read(self):
+        if not os.path.exists(self.path):
+            return np.zeros(0), np.zeros(0), np.zeros((0, self.nParams))
+        records = np.fromfile(self.path, dtype=np.float64)
+        records = records[:len(records) - len(records) % (self.nParams + 2)].reshape(-1, self.nParams + 2)
+        return records[:,0], records[:,1], records[:,2:]
+
+
+# run manager for long global fits
+# the objective (e.g. ResidualObjective or a cost function with bound arguments) is sent once to every pool process,
+# every evaluation is appended to runDir/evaluations.bin and the optimizer state is checkpointed to runDir/checkpoint.npz,
+# a run started again in the same directory resumes from the checkpoint
+# progress is reported to log (log=None: silent)
+# use as a context manager or call close() when done
+class OptimizationRun:
+
+    def __init__(self, objective, bounds, runDir, nprocs=None, log=sys.stderr):
+        self.objective = objective
+        self.bounds = list(bounds)
+        self.nParams = len(self.bounds)
+        self.runDir = runDir
+        self.log = log
+        os.makedirs(runDir, exist_ok=True)
+        self.checkpointFile = os.path.join(runDir, "checkpoint.npz")
+        self.evaluations = EvaluationLog(os.path.join(runDir, "evaluations.bin"), self.nParams)
+
+        # nprocs=1 evaluates in this process
+        self.nprocs = nprocs or os.cpu_count()
+        if nprocs == 1:
+            _initObjective(objective)
+            self.pool = None
+        else:
+            self.pool = ProcessPoolExecutor(max_workers=nprocs, initializer=_initObjective, initargs=(objective,))
+
+        self.bestX = None
+        self.bestCost = np.inf
+        self.startTime = time.time()
+        # (population, energies) of a resumed differential evolution, see evaluatePopulation
+        self.resumeEnergies = None
+        checkpoint = self.loadCheckpoint()
+        if checkpoint is not None:
+            self.bestX = checkpoint["x"]
+            self.bestCost = float(checkpoint["fun"])
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def loadCheckpoint(self):
+        if not os.path.exists(self.checkpointFile):
+            return None
+        with np.load(self.checkpointFile) as f:
+            return {k: f[k] for k in f.files}
+
+    # written to a temporary file first, an interrupted write keeps the previous checkpoint
+    def saveCheckpoint(self, **state):
+        tmpFile = self.checkpointFile + "." + str(os.getpid()) + ".tmp"
+        with open(tmpFile, "wb") as f:
+            np.savez(f, x=self.bestX, fun=self.bestCost, **state)
+        os.replace(tmpFile, self.checkpointFile)
+
+    def record(self, wallTimes, costs, X):
+        self.evaluations.append(wallTimes, costs, X)
+        k = int(np.argmin(costs))
+        if costs[k] < self.bestCost:
+            self.bestCost = float(costs[k])
+            self.bestX = np.array(X[k])
+
+    def report(self, message):
+        if self.log is not None:
+            self.log.write("[%.0f s] %s, best cost %.6g\n" % (time.time() - self.startTime, message, self.bestCost))
+            self.log.flush()
+
+    # map-like evaluation of a population, passed to differential_evolution as workers
+    # the population goes to the pool processes which hold their own copy of the objective
+    # the checkpointed population of a resumed run is not evaluated again, its saved energies are returned
+    def evaluatePopulation(self, func, population):
+        population = np.asarray(list(population))
+        if self.resumeEnergies is not None:
+            saved, energies = self.resumeEnergies
+            self.resumeEnergies = None
+            # differential_evolution rescales the initial population, equal up to rounding
+            width = np.array([b[1] - b[0] for b in self.bounds])
+            if population.shape == saved.shape and np.all(np.abs(population - saved) <= 1e-12 * width):
+                return np.array(energies, dtype=float)
+        if self.pool is None:
+            results = [_evaluate(x) for x in population]
+        else:
+            chunksize = max(1, len(population) // (4 * self.nprocs))
+            results = list(self.pool.map(_evaluate, population, chunksize=chunksize))
+        costs = np.array([cost for cost, _ in results])
+        self.record(np.array([t for _, t in results]), costs, population)
+        return costs
+
+    # differential evolution with the population evaluated in parallel
+    # the population is checkpointed every checkpointEvery generations, resume continues from the saved
+    # population and generation count (maxiter is the total number of generations)
+    # further options are passed to differential_evolution (popsize, mutation, recombination, tol, ...)
+    def differentialEvolution(self, maxiter=1000, seed=None, resume=True, checkpointEvery=1, **options):
+        checkpoint = self.loadCheckpoint() if resume else None
+        nit = 0
+        if checkpoint is not None and str(checkpoint.get("method", "")) == "differentialEvolution":
+            nit = int(checkpoint["nit"])
+            options["init"] = checkpoint["population"]
+            if "energies" in checkpoint:
+                self.resumeEnergies = (checkpoint["population"], checkpoint["energies"])
+            self.report("resuming differential evolution at generation %d" % nit)
+
+        def callback(intermediate_result):
+            callback.nit += 1
+            if callback.nit % checkpointEvery == 0 or callback.nit + nit >= maxiter:
+                self.saveCheckpoint(method="differentialEvolution", nit=nit + callback.nit, \
+                    population=intermediate_result.population, energies=intermediate_result.population_energies)
+            self.report("generation %d" % (nit + callback.nit))
+        callback.nit = 0
+
+        options.setdefault("polish", False)
+        opt = differential_evolution(self.objective, self.bounds, maxiter=max(maxiter - nit, 0), seed=seed, \
+            workers=self.evaluatePopulation, updating="deferred", callback=callback, **options)
+        opt.nit += nit
+        return opt
+
+    # local searches from several starting points spread over the pool processes
+    # starts is the number of random (uniform within the bounds) starting points or an array of them
+    # the results of finished searches are checkpointed, resume skips them
+    def multiStart(self, starts, method="L-BFGS-B", seed=None, resume=True, **options):
+        checkpoint = self.loadCheckpoint() if resume else None
+        if checkpoint is not None and str(checkpoint.get("method", "")) == "multiStart":
+            starts = checkpoint["starts"]
+            done = checkpoint["done"].astype(bool)
+            results = checkpoint["results"]
+            self.report("resuming multi-start, %d of %d searches done" % (np.sum(done), len(starts)))
+        else:
+            if np.isscalar(starts):
+                lower = np.array([b[0] for b in self.bounds])
+                upper = np.array([b[1] for b in self.bounds])
+                starts = lower + np.random.default_rng(seed).random((int(starts), self.nParams)) * (upper - lower)
+            starts = np.asarray(starts, dtype=float)
+            done = np.zeros(len(starts), dtype=bool)
+            results = np.full((len(starts), self.nParams + 1), np.nan)
+
+        def finish(k, opt, trace):
+            if len(trace) > 0:
+                self.record(np.array([t for t, _, _ in trace]), np.array([c for _, c, _ in trace]), np.array([x for _, _, x in trace]))
+            done[k] = True
+            results[k, 0] = opt.fun
+            results[k, 1:] = opt.x
+            self.saveCheckpoint(method="multiStart", starts=starts, done=done, results=results)
+            self.report("local search %d finished (%d of %d), cost %.6g" % (k, np.sum(done), len(starts), opt.fun))
+
+        todo = np.flatnonzero(~done)
+        if self.pool is None:
+            for k in todo:
+                finish(k, *_localSearch(starts[k], self.bounds, method, options))
+        else:
+            futures = {self.pool.submit(_localSearch, starts[k], self.bounds, method, options): k for k in todo}
+            for future in as_completed(futures):
+                finish(futures[future], *future.result())
+
+        best = int(np.nanargmin(results[:,0]))
+        return OptimizeResult(x=results[best, 1:], fun=results[best, 0], starts=starts, results=results, \
+            success=True, nstarts=len(starts))
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import sys
+import csv
+import gzip
+import time
+import itertools
+from rdkit import Chem
+from rdkit.Chem import AllChem
+from qcalc.model import ChargeModel
+
+# molecule from SMILES with one embedded conformer, None on failure
+def embedSmiles(smiles, randomSeed=42):
+    mol = Chem.MolFromSmiles(smiles)
+    if mol is None:
+        return None
+    mol = Chem.AddHs(mol)
+    if AllChem.EmbedMolecule(mol, randomSeed=randomSeed) != 0:
+        return None
+    return mol
+
+# lazily read molecules from SDF (.sdf, .sdf.gz) or SMILES (.smi, .smiles: "SMILES [name]" per line)
+# yields (name, mol), mol is None if the entry could not be read
+def readMolecules(path, randomSeed=42):
+    if path.endswith(".smi") or path.endswith(".smiles"):
+        with open(path) as f:
+            for k, line in enumerate(f):
+                fields = line.split()
+                if len(fields) == 0 or fields[0].startswith("#"):
+                    continue
+                name = fields[1] if len(fields) > 1 else str(k)
+                yield name, embedSmiles(fields[0], randomSeed)
+    else:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rb") as f:
+            for k, mol in enumerate(Chem.ForwardSDMolSupplier(f, removeHs=False)):
+                name = str(k)
+                if mol is not None and mol.HasProp("_Name") and mol.GetProp("_Name"):
+                    name = mol.GetProp("_Name")
+                yield name, mol
+
+# charges for a stream of (name, mol) with one ChargeModel
+# charges are computed on heavy atoms (Hs removed); netCharge="formal" uses the formal charge of each molecule
+# yields (name, mol without Hs, atom types, charges, error), charges are None on failure
+def chargeStream(molecules, paramTable, method, atomTypeFunc, **kwargs):
+    formal = kwargs.get("netCharge", 0) == "formal"
+    if formal:
+        kwargs["netCharge"] = 0
+    model = ChargeModel(paramTable, method, atomTypeFunc, **kwargs)
+    for name, mol in molecules:
+        if mol is None:
+            yield name, None, None, None, "could not read molecule"
+            continue
+        try:
+            m = Chem.RemoveHs(mol)
+            netCharge = Chem.GetFormalCharge(m) if formal else None
+            worker = model.createWorker(m, netCharge)
+            yield name, m, worker.atomTypes, worker.compute(), None
+        except Exception as e:
+            yield name, mol, None, None, repr(e)
+
+# incremental writers, flush() is called after every chunk
+class CSVChargeWriter:
+
+    def __init__(self, path):
+        self.file = open(path, "w", newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(["molecule", "name", "atom", "symbol", "type", "charge", "error"])
+        self.count = 0
+
+    def write(self, name, mol, atomTypes, charges, error):
+        if charges is None:
+            self.writer.writerow([self.count, name, "", "", "", "", error])
+        else:
+            for i, (atom, atomType, q) in enumerate(zip(mol.GetAtoms(), atomTypes, charges)):
+                self.writer.writerow([self.count, name, i, atom.GetSymbol(), atomType, repr(float(q)), ""])
+        self.count += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+# charges go to the atom property qcalc_charge (SD tag atom.dprop.qcalc_charge)
+# failed molecules are skipped, the error is kept in the qcalc_error tag if the molecule could be read
+class SDFChargeWriter:
+
+    def __init__(self, path):
+        self.writer = Chem.SDWriter(path)
+
+    def write(self, name, mol, atomTypes, charges, error):
+        if mol is None:
+            return
+        if charges is None:
+            mol.SetProp("qcalc_error", error)
+        else:
+            for atom, q in zip(mol.GetAtoms(), charges):
+                atom.SetDoubleProp("qcalc_charge", float(q))
+            Chem.CreateAtomDoublePropertyList(mol, "qcalc_charge")
+        self.writer.write(mol)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+def createWriter(path):
+    if path.endswith(".csv"):
+        return CSVChargeWriter(path)
+    return SDFChargeWriter(path)
+
+# read, charge and write chunk by chunk, memory stays bounded by chunkSize molecules
+# progress/throughput is reported to log after every chunk (log=None: silent)
+# returns dict with counts and timings
+def chargeFile(inputPath, outputPath, paramTable, method, atomTypeFunc, chunkSize=1000, log=sys.stderr, **kwargs):
+    stats = dict(molecules=0, failures=0, atoms=0)
+    start = time.time()
+    writer = createWriter(outputPath)
+    results = chargeStream(readMolecules(inputPath), paramTable, method, atomTypeFunc, **kwargs)
+    try:
+        while True:
+            chunk = list(itertools.islice(results, chunkSize))
+            if len(chunk) == 0:
+                break
+            for name, mol, atomTypes, charges, error in chunk:
+                writer.write(name, mol, atomTypes, charges, error)
+                stats["molecules"] += 1
+                if charges is None:
+                    stats["failures"] += 1
+                else:
+                    stats["atoms"] += len(charges)
+            writer.flush()
+            if log is not None:
+                elapsed = time.time() - start
+                log.write("%d molecules (%d failed), %.1f molecules/s\n" % (stats["molecules"], stats["failures"], stats["molecules"] / elapsed))
+                log.flush()
+    finally:
+        writer.close()
+    stats["seconds"] = time.time() - start
+    stats["moleculesPerSecond"] = stats["molecules"] / stats["seconds"] if stats["seconds"] > 0 else 0.
+    return stats
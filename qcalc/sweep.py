@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import time
+import numpy as np
+import pandas as pd
+from itertools import product
+from concurrent.futures import ProcessPoolExecutor
+from rdkit import Chem
+from qcalc.workers import createParameters, prepareMolecule, createWorkerFromData
+from qcalc.core.BondChargeDistributionMethod import BondChargeDistributionMethod
+
+# configuration columns of the result tables
+CONFIG_COLUMNS = ["method", "maxOrder", "fpepsi", "kappa", "lam"]
+
+# all combinations as a list of configuration dicts
+# kappa and lam only vary for SQE, the other methods get one configuration each
+def sweepGrid(methods, maxOrder=(1,), fpepsi=(False,), kappa=(1,), lam=(1,)):
+    configurations = []
+    for method, m, f in product(methods, maxOrder, fpepsi):
+        scalings = product(kappa, lam) if method == "SQE" else [(1, 1)]
+        for k, l in scalings:
+            configurations.append(dict(method=method, maxOrder=m, fpepsi=f, kappa=k, lam=l))
+    return configurations
+
+
+# sweep state of the current process, set once per pool process by the initializer
+_sweep = None
+
+def _initSweep(sweep):
+    global _sweep
+    _sweep = sweep
+
+# all configurations for one molecule
+# geometry-only caches are shared between configurations with the same maxOrder, fpepsi and diameters:
+# one Coulomb matrix for all methods, one set of bond variables and bond-space Coulomb matrix for all bond methods
+# returns per-atom columns, per-configuration timings and an error message (None on success)
+def _sweepMolecule(task):
+    k, mol, targetCharges = task
+    s = _sweep
+    try:
+        if isinstance(mol, bytes):
+            mol = Chem.Mol(mol)
+        t = time.time()
+        if isinstance(mol, dict):
+            molData = mol
+        else:
+            molData = prepareMolecule(mol, s["atomTypeFunc"], s["bondTypeFunc"], s["maxOrderBound"])
+        prepareTime = time.time() - t
+
+        atomTypes = np.asarray(molData["atomTypes"])
+        N = len(atomTypes)
+        sources = dict()
+        columns = {c: [] for c in CONFIG_COLUMNS + ["molecule", "atom", "atomType", "charge"]}
+        timings = {c: [] for c in CONFIG_COLUMNS + ["molecule", "N", "prepare", "setup", "solve"]}
+        for config in s["configurations"]:
+            method = config["method"]
+            params, bondParams = s["params"][method]
+            t = time.time()
+            worker = createWorkerFromData(molData, params, method, bondParams=bondParams, netCharge=s["netCharge"], \
+                maxOrder=config["maxOrder"], fpepsi=config["fpepsi"], kappa=config["kappa"], lam=config["lam"])
+            key = (config["maxOrder"], config["fpepsi"], worker.diameters.tobytes())
+            source = sources.get(key, None)
+            if source is not None:
+                worker.adoptGeometry(source)
+            worker.precompute()
+            if source is None or (isinstance(worker, BondChargeDistributionMethod) and not isinstance(source, BondChargeDistributionMethod)):
+                sources[key] = worker
+            setupTime = time.time() - t
+
+            t = time.time()
+            charges = worker.compute()
+            solveTime = time.time() - t
+
+            for c in CONFIG_COLUMNS:
+                columns[c].append(np.repeat(config[c], N))
+                timings[c].append(config[c])
+            columns["molecule"].append(np.repeat(k, N))
+            columns["atom"].append(np.arange(N))
+            columns["atomType"].append(atomTypes)
+            columns["charge"].append(charges)
+            timings["molecule"].append(k)
+            timings["N"].append(N)
+            timings["prepare"].append(prepareTime)
+            timings["setup"].append(setupTime)
+            timings["solve"].append(solveTime)
+            # preprocessing is done once per molecule
+            prepareTime = 0.
+
+        columns = {c: np.concatenate(v) for c, v in columns.items()}
+        if targetCharges is not None:
+            columns["target"] = np.tile(np.asarray(targetCharges, dtype=float), len(s["configurations"]))
+            columns["error"] = columns["charge"] - columns["target"]
+        return columns, timings, None
+    except Exception as e:
+        return None, None, repr(e)
+
+
+# charges of all molecules for all configurations (see sweepGrid)
+# mols can be RDKit molecules or molData dicts (prepareMolecule with the largest maxOrder of the sweep, MoleculeCache)
+# paramTable/bondParamTable: one table for all methods or a dict {method: table}
+# molecules are spread over a process pool (nprocs=1: this process), all configurations of a molecule run in the same
+# process so that they share preprocessing and Coulomb matrices
+# atomTypeFunc and bondTypeFunc must be picklable (defined at module level)
+# returns a per-atom table (charges, and target/error if targetCharges are given), a per-configuration timing table
+# and a list of (molecule index, error message)
+def runSweep(mols, paramTable, configurations, atomTypeFunc, bondTypeFunc=None, bondParamTable=None, targetCharges=None, \
+        netCharge=0, nprocs=None, chunksize=4):
+
+    # parameter objects are built once per method
+    params = dict()
+    for method in set(c["method"] for c in configurations):
+        table = paramTable[method] if isinstance(paramTable, dict) else paramTable
+        bondTable = bondParamTable[method] if isinstance(bondParamTable, dict) else bondParamTable
+        params[method] = createParameters(table, method, copy=False, bondParamTable=bondTable)
+    bondMethods = any(c["method"] in ["AACT", "SQE"] for c in configurations)
+    sweep = dict(params=params, configurations=configurations, atomTypeFunc=atomTypeFunc, netCharge=netCharge, \
+        bondTypeFunc=bondTypeFunc if bondMethods else None, maxOrderBound=max(max(c["maxOrder"] for c in configurations), 1))
+
+    # RDKit pickles coordinates in single precision
+    options = Chem.PropertyPickleOptions.AllProps | Chem.PropertyPickleOptions.CoordsAsDouble
+    tasks = [(k, mol.ToBinary(options) if isinstance(mol, Chem.Mol) else mol, None if targetCharges is None else targetCharges[k]) \
+        for k, mol in enumerate(mols)]
+    if nprocs == 1:
+        _initSweep(sweep)
+        results = [_sweepMolecule(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=nprocs, initializer=_initSweep, initargs=(sweep,)) as pool:
+            results = list(pool.map(_sweepMolecule, tasks, chunksize=chunksize))
+
+    failures = [(k, error) for k, (_, _, error) in enumerate(results) if error is not None]
+    done = [(columns, timings) for columns, timings, error in results if error is None]
+    if len(done) == 0:
+        return pd.DataFrame(), pd.DataFrame(), failures
+    charges = pd.DataFrame({c: np.concatenate([columns[c] for columns, _ in done]) for c in done[0][0]})
+    timings = pd.DataFrame({c: np.concatenate([timings[c] for _, timings in done]) for c in done[0][1]})
+    return charges, timings, failures
+
+
+# error statistics per configuration and atom type from the per-atom table of runSweep
+def errorsByAtomType(charges):
+    grouped = charges.assign(absError=charges["error"].abs(), sqError=charges["error"]**2) \
+        .groupby(CONFIG_COLUMNS + ["atomType"])
+    stats = grouped.agg(count=("error", "size"), mae=("absError", "mean"), rmse=("sqError", "mean"), maxError=("absError", "max"))
+    stats["rmse"] = np.sqrt(stats["rmse"])
+    return stats.reset_index()
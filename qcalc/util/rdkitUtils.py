@@ -4,7 +4,8 @@ from rdkit.Chem import rdchem
 import numpy as np
 from scipy.spatial import distance_matrix
 import pandas as pd
-from qcalc.util.utils import getConnectivity
+from qcalc.util.utils import getConnectivity, getSparseConnectivity, getSparseDistances
+from qcalc import instrument
 
 # add charge on H to charge of atom it is bonded to
 def _addChargeH(atom, hAtom):
@@ -17,7 +18,10 @@ def _addChargeH(atom, hAtom):
     hAtom.SetDoubleProp("charge", 0)
 
 
-def extractMol(mol):
+# maxOrder: depth bound for the connectivity matrix, see getConnectivity
+# sparse: connectivity and distances as sparse matrices holding only the pairs within maxOrder (and cutoff, nm),
+# see getSparseConnectivity and getSparseDistances
+def extractMol(mol, maxOrder=None, sparse=False, cutoff=None):
     
     m = Chem.RemoveHs(mol)
     
@@ -32,12 +36,22 @@ def extractMol(mol):
         bonds.append([b1.GetIdx(), b2.GetIdx()])
             
     # create connectivity & distance matrix
-    connectivity = getConnectivity(atoms, bonds)
+    t = instrument.start()
+    if sparse:
+        connectivity = getSparseConnectivity(atoms, bonds, maxOrder)
+    else:
+        connectivity = getConnectivity(atoms, bonds, maxOrder)
+    instrument.stop("connectivity", t, len(atoms))
     
     # calculate distance matrix
+    t = instrument.start()
     conf = m.GetConformers()[0]
     positions = 0.1*conf.GetPositions()  # A -> nm
-    distanceMatrix = distance_matrix(positions, positions)
+    if sparse:
+        distanceMatrix = getSparseDistances(positions, connectivity, cutoff)
+    else:
+        distanceMatrix = distance_matrix(positions, positions)
+    instrument.stop("distanceMatrix", t, len(atoms))
         
     # store everything in a dict
     molData = dict()
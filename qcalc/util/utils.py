@@ -1,30 +1,71 @@
 import numpy as np
+from scipy.sparse import csr_matrix, identity
+from scipy.sparse.csgraph import dijkstra, connected_components
+from scipy.spatial import cKDTree
 
-def getConnectivity(atoms, bonds):
-    # create connectivity matrix
-    connectivity = np.zeros((len(atoms), len(atoms)))
+# sparse adjacency matrix of the molecular graph
+def getBondGraph(atoms, bonds):
+    N = len(atoms)
+    bonds = np.array(bonds, dtype=int).reshape(-1, 2)
+    data = np.ones(len(bonds))
+    return csr_matrix((data, (bonds[:,0], bonds[:,1])), shape=(N, N))
 
-    # add bonds
-    for b in bonds:
-        connectivity[b[0],b[1]] = 1
-        connectivity[b[1],b[0]] = 1
+# topological distances (number of bonds) between all atoms
+# maxOrder: only search up to this depth, pairs further apart are set to np.inf
+# atoms in different fragments (salts, multi-fragment inputs) are np.inf as well
+def getConnectivity(atoms, bonds, maxOrder=None):
+    graph = getBondGraph(atoms, bonds)
+    limit = np.inf if maxOrder is None else maxOrder
+    connectivity = dijkstra(graph, directed=False, unweighted=True, limit=limit)
+    return connectivity
 
-    # higher-order connectivity 
-    while (len(np.where(connectivity == 0)[0]) > len(atoms)):
-        tmpConnectivity = connectivity.copy()
-        #loop over matrix
-        for i in range(0,len(atoms)):
-            neighborsI = [idx for idx,k in enumerate(connectivity[i]) if (k == 1)]
-            #print("---" + str(neighborsI) + "---")
-            for ni in neighborsI:
-                neighborsJ = [idx for idx,k in enumerate(connectivity[ni]) if (k)]
-                #print(neighborsJ)
-                for nj in neighborsJ:
-                    if connectivity[i,nj] == 0 and i != nj:
-                        order = connectivity[i,ni] + connectivity[ni,nj]
-                        tmpConnectivity[i,nj] = order
-                        tmpConnectivity[nj,i] = order
+# same as getConnectivity as a sparse matrix (CSR), from a breadth-first search of depth maxOrder
+# only pairs within maxOrder bonds are stored, the diagonal and pairs further apart are left out
+# time and memory grow with the number of stored pairs instead of N^2
+def getSparseConnectivity(atoms, bonds, maxOrder):
+    if maxOrder is None or not np.isfinite(maxOrder):
+        raise Exception("sparse connectivity needs a finite maxOrder")
+    N = len(atoms)
+    graph = getBondGraph(atoms, bonds)
+    graph = ((graph + graph.T) > 0).astype(float)
+    reached = identity(N, format="csr")
+    frontier = reached
+    connectivity = csr_matrix((N, N))
+    for order in range(1, int(maxOrder) + 1):
+        # atoms one bond beyond the current shell, which were not reached before
+        frontier = ((frontier @ graph) > 0).astype(float)
+        frontier = frontier - frontier.multiply(reached)
+        frontier.eliminate_zeros()
+        if frontier.nnz == 0:
+            break
+        reached = reached + frontier
+        connectivity = connectivity + order * frontier
+    return connectivity.tocsr()
 
-        connectivity = tmpConnectivity.copy()  
-        
-    return connectivity
\ No newline at end of file
+# distances between the pairs stored in a sparse connectivity matrix, same pattern (CSR)
+# positions: N x 3
+# cutoff: only pairs within the cutoff are kept, found with a k-d tree
+def getSparseDistances(positions, connectivity, cutoff=None):
+    N = len(positions)
+    if cutoff is None:
+        pairs = connectivity.tocoo()
+        dist = np.linalg.norm(positions[pairs.row] - positions[pairs.col], axis=1)
+        return csr_matrix((dist, (pairs.row, pairs.col)), shape=(N, N))
+    tree = cKDTree(positions)
+    distances = tree.sparse_distance_matrix(tree, cutoff, output_type="coo_matrix").tocsr()
+    pattern = connectivity.copy()
+    pattern.data[:] = 1
+    distances = distances.multiply(pattern).tocsr()
+    distances.eliminate_zeros()
+    return distances
+
+# fragment index of every atom
+def getFragments(atoms, bonds):
+    nFragments, labels = connected_components(getBondGraph(atoms, bonds), directed=False)
+    return labels
+
+# pairs of atoms (i < j) which are not connected by any path
+def getUnreachablePairs(atoms, bonds):
+    labels = getFragments(atoms, bonds)
+    unreachable = np.triu(labels[:,None] != labels[None,:], 1)
+    return np.argwhere(unreachable)
@@ -1,34 +1,36 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-import numpy as np
+from scipy.sparse import issparse
 from qcalc.core.EEM import EEM
 from qcalc.core.QeqAtomic import QEqAtomic
 from qcalc.core.QeqBond import QEqBond
 from qcalc.core.AACT import AACT
 from qcalc.core.SQE import SQE
-from qcalc.util.utils import getConnectivity
 from qcalc.util.rdkitUtils import extractMol, getAtomLabels, getBondLabels
 from qcalc.parameter import Parameter
+from qcalc import instrument
 
 def computeCharges (mol, paramTable, method, atomTypeFunc, **kwargs):
-    params, bondParams = createParameters(paramTable, method, **kwargs)
+    # parameters are not updated here, no need to copy the tables
+    params, bondParams = createParameters(paramTable, method, copy=False, **kwargs)
     worker = createWorker(mol, params, method, atomTypeFunc, bondParams=bondParams, **kwargs)
     charges = worker.compute()
     return charges
 
 # called only once
-def createParameters(paramTable, method, **kwargs):
+# copy=False shares the tables with the caller (read-only use)
+def createParameters(paramTable, method, copy=True, **kwargs):
 
     # create atomic params
-    params = Parameter(paramTable)
+    params = Parameter(paramTable, copy)
 
     # for bond methods: create bond parasm
     if method == "AACT" or method == "SQE":
         bondParamTable = kwargs.get("bondParamTable", None)
         if bondParamTable is None:
             raise Exception("bondParams is required for AACT and SQE")
-        bondParams = Parameter(bondParamTable)
+        bondParams = Parameter(bondParamTable, copy)
     else:
         bondParams = None
 
@@ -54,27 +56,60 @@ def createParameters(paramTable, method, **kwargs):
 # called once for every molecule
 def createWorker (mol, params, method, atomTypeFunc, **kwargs):
 
+    # topological distances beyond maxOrder (at least 1 for the charge transfer topology) are not needed
+    maxOrder = kwargs.get("maxOrder", 1)
+    bondTypeFunc = kwargs.get("bondTypeFunc", None)
+    # sparse mode also keeps the geometry sparse
+    sparse = kwargs.get("sparse", False)
+    t = instrument.start()
+    molData = prepareMolecule(mol, atomTypeFunc, bondTypeFunc, max(maxOrder, 1), sparse, kwargs.get("cutoff", None) if sparse else None)
+    worker = createWorkerFromData(molData, params, method, **kwargs)
+    instrument.stop("createWorker", t, worker.N)
+    return worker
+
+# everything a worker needs from a molecule, as plain arrays (no RDKit objects)
+# maxOrder: depth bound for the connectivity matrix, None keeps all topological distances
+# sparse: sparse connectivity and distance matrices with the pairs within maxOrder (and cutoff) only, see extractMol
+def prepareMolecule (mol, atomTypeFunc, bondTypeFunc=None, maxOrder=None, sparse=False, cutoff=None):
+
+    # extract info from molecule
+    t = instrument.start()
+    molDict = extractMol(mol, maxOrder, sparse, cutoff)
+    instrument.stop("extractMol", t, len(molDict["atoms"]))
+
+    molData = dict()
+    molData["connectivity"] = molDict["connectivity"]
+    molData["distanceMatrix"] = molDict["distanceMatrix"]
+
+    # initialize atom and bond types
+    t = instrument.start()
+    molData["atomTypes"] = getAtomLabels(mol, atomTypeFunc)
+    if bondTypeFunc is not None:
+        molData["bondTypes"] = getBondLabels(mol, bondTypeFunc)
+    instrument.stop("typing", t, len(molData["atomTypes"]))
+    return molData
+
+# molData: output of prepareMolecule
+def createWorkerFromData (molData, params, method, **kwargs):
+
+    t = instrument.start()
+
     # optional parameters
     netCharge = kwargs.get("netCharge", 0)
     maxOrder = kwargs.get("maxOrder", 1)
     fpepsi = kwargs.get("fpepsi", False)
     bondParams = kwargs.get("bondParams", None)
 
-    # extract info from molecule
-    molDict = extractMol(mol)
-    atoms = molDict["atoms"]
-    connectivity = molDict["connectivity"]
-    distanceMatrix = molDict["distanceMatrix"]
-
-    # function to assign bond types
-    bondTypeFunc = kwargs.get("bondTypeFunc", None)
+    connectivity = molData["connectivity"]
+    distanceMatrix = molData["distanceMatrix"]
 
     # charge transfer topology: coupling over bonds
-    chargeTransferFilter = lambda x: 1 if (x <= 1) else 0
-    chargeTransferTopology = np.vectorize(chargeTransferFilter)(connectivity)
+    if issparse(connectivity):
+        chargeTransferTopology = (connectivity == 1).astype(int)
+    else:
+        chargeTransferTopology = (connectivity <= 1).astype(int)
 
-    # initialize atom types
-    atomTypes = getAtomLabels(mol, atomTypeFunc)
+    atomTypes = molData["atomTypes"]
 
     # extract atomic params
     electronegativity = params.extractProp(atomTypes, "atom", "electronegativity")
@@ -85,9 +120,9 @@ def createWorker (mol, params, method, atomTypeFunc, **kwargs):
     if method == "AACT" or method == "SQE":
         if bondParams is None:
             raise Exception("bondParams not provided. This is most likely a bug in the top-level function.")
-        if bondTypeFunc is None:
+        if "bondTypes" not in molData:
             raise Exception("bondTypeFunc is required for AACT and SQE")
-        bondTypes = getBondLabels(mol, bondTypeFunc)
+        bondTypes = molData["bondTypes"]
         bondElneg = bondParams.extractProp(bondTypes, "type", "electronegativity")
         bondHardness = bondParams.extractProp(bondTypes, "type", "hardness")
     
@@ -109,6 +144,13 @@ def createWorker (mol, params, method, atomTypeFunc, **kwargs):
     else:
         raise Exception("method " + method + "is undefined")
 
+    # sparse matrices and Krylov solver for large systems (EEM, QeqAtomic)
+    # a Coulomb cutoff (nm) can also be used in dense mode
+    sparse = kwargs.get("sparse", False)
+    cutoff = kwargs.get("cutoff", None)
+    if sparse or cutoff is not None:
+        worker.setSparse(sparse, cutoff, kwargs.get("krylovSolver", "cg"), kwargs.get("krylovTol", 1e-10), kwargs.get("krylovMaxiter", None))
+
     # needed for custom weighting schemes
     worker.atomTypes = atomTypes
 
@@ -121,6 +163,7 @@ def createWorker (mol, params, method, atomTypeFunc, **kwargs):
     else:
         worker.setIndices(indices, params.N)
 
+    instrument.stop("createWorkerFromData", t, worker.N)
     return worker
 
 if __name__ == "__main__":
@@ -12,4 +12,7 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     license='MIT',
+    entry_points={
+        "console_scripts": ["qcalc=qcalc.cli:main"],
+    },
 )
\ No newline at end of file
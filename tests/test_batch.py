@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import numpy as np
+import pandas as pd
+import pytest
+from rdkit import Chem
+from rdkit.Chem import AllChem
+from qcalc.batch import BatchSolver
+from qcalc.parameter import ParameterVector
+from qcalc.workers import createParameters, createWorker
+
+def atomType(atom, mol):
+    return atom.GetSymbol()
+
+def molecule(smiles):
+    mol = Chem.AddHs(Chem.MolFromSmiles(smiles))
+    AllChem.EmbedMolecule(mol, randomSeed=7)
+    return Chem.RemoveHs(mol)
+
+# two molecules of the same size (one bucket) and one of another size
+SMILES = ["ClCCCCl", "ClCC(Cl)CC", "ClCCCCCl"]
+
+
+# after a batch solve the wrapped workers hold the same state as after their own compute
+@pytest.mark.parametrize("method", ["EEM", "QeqAtomic"])
+def test_batch_updates_workers(method):
+    table = pd.DataFrame({"atom": ["C", "Cl"], "electronegativity": [6.0, 8.5], "hardness": [10.0, 9.0], \
+        "diameter": [0.17, 0.175]})
+    params, bondParams = createParameters(table, method)
+    workers = [createWorker(molecule(s), params, method, atomType, maxOrder=2) for s in SMILES]
+    batch = BatchSolver(workers)
+    paramsArr = ParameterVector(params).values * 1.1
+    batch.setParams(paramsArr)
+    charges = batch.compute()
+
+    for smiles, worker, q in zip(SMILES, workers, charges):
+        single = createWorker(molecule(smiles), params, method, atomType, maxOrder=2)
+        single.setParams(paramsArr)
+        assert np.allclose(worker.electronegativity, single.electronegativity)
+        assert np.allclose(worker.hardness, single.hardness)
+        assert np.allclose(q, single.compute(), atol=1e-12)
+        assert np.allclose(worker.compute(), q, atol=1e-12)
+        if method == "EEM":
+            assert np.isclose(worker.electronegativityEq, single.electronegativityEq)
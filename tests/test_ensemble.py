@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import numpy as np
+import pandas as pd
+import pytest
+from rdkit import Chem
+from rdkit.Chem import AllChem
+from scipy.spatial import distance_matrix
+from qcalc.model import ChargeModel
+from qcalc.ensemble import createEnsemble
+
+def atomType(atom, mol):
+    return atom.GetSymbol()
+
+def bondType(bond, mol):
+    return "-".join(sorted([bond.GetBeginAtom().GetSymbol(), bond.GetEndAtom().GetSymbol()]))
+
+
+# every conformer of a ring molecule gives the charges and bond charges of its own worker
+@pytest.mark.parametrize("method", ["QeqBond", "AACT", "SQE"])
+def test_ensemble_ring_bond_charges(method):
+    table = pd.DataFrame({"atom": ["C", "Cl"], "electronegativity": [6.0, 8.5], "hardness": [10.0, 9.0], \
+        "diameter": [0.17, 0.175]})
+    bondTable = pd.DataFrame({"type": ["C-C", "C-Cl"], "electronegativity": [0.0, 0.0], "hardness": [9.0, 11.0]})
+    model = ChargeModel(table, method, atomType, bondTypeFunc=bondType, bondParamTable=bondTable, maxOrder=2)
+    mol = Chem.AddHs(Chem.MolFromSmiles("ClC1CC2CC(Cl)CC2CC1"))
+    AllChem.EmbedMultipleConfs(mol, 3, randomSeed=7)
+    ensemble = createEnsemble(mol, model)
+    charges = ensemble.compute()
+
+    m = Chem.RemoveHs(mol)
+    for k, conf in enumerate(m.GetConformers()):
+        worker = model.createWorker(m)
+        positions = 0.1 * conf.GetPositions()
+        worker.setGeometry(distanceMatrix=distance_matrix(positions, positions))
+        assert np.allclose(charges[k], worker.compute(), atol=1e-12)
+        assert np.allclose(ensemble.bondCharges[k], worker.bondCharges, atol=1e-12)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import pickle
+import multiprocessing as mp
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import pytest
+from rdkit import Chem
+from rdkit.Chem import AllChem
+import qcalc.optimize
+from qcalc.core.QeqBond import QEqBond
+from qcalc.workers import createParameters, createWorker
+from qcalc.optimize import createWorkersParallel
+
+# two-type model: C and Cl
+def atomType(atom, mol):
+    return atom.GetSymbol()
+
+def parameters(method):
+    table = pd.DataFrame({"atom": ["C", "Cl"], "electronegativity": [6.0, 8.5], "hardness": [10.0, 9.0], \
+        "diameter": [0.17, 0.175]})
+    return createParameters(table, method)
+
+def molecule(smiles):
+    mol = Chem.AddHs(Chem.MolFromSmiles(smiles))
+    AllChem.EmbedMolecule(mol, randomSeed=7)
+    return Chem.RemoveHs(mol)
+
+CHAIN = "ClCCCCl"
+RING = "ClC1CC2CC(Cl)CC2CC1"
+
+
+# ring systems keep the grounded Laplacian of the spanning tree, the worker must still round-trip
+def test_pickle_ring_QeqBond():
+    params, bondParams = parameters("QeqBond")
+    worker = createWorker(molecule(RING), params, "QeqBond", atomType, bondParams=bondParams, maxOrder=2)
+    charges = worker.compute()
+    assert worker.treeBonds is not None
+    copy = pickle.loads(pickle.dumps(worker))
+    assert np.allclose(copy.compute(), charges, atol=1e-14)
+    assert np.allclose(copy.bondCharges, worker.bondCharges, atol=1e-14)
+
+
+def test_createWorkersParallel_ring():
+    params, bondParams = parameters("QeqBond")
+    mols = [molecule(CHAIN), molecule(RING), molecule(CHAIN)]
+    workers, failures = createWorkersParallel(mols, params, "QeqBond", atomType, bondParams, nprocs=2, chunksize=2, maxOrder=2)
+    assert failures == []
+    for mol, worker in zip(mols, workers):
+        serial = createWorker(mol, params, "QeqBond", atomType, bondParams=bondParams, maxOrder=2)
+        assert np.allclose(worker.compute(), serial.compute(), atol=1e-14)
+
+
+# a worker which cannot be sent back to the parent only fails its own molecule
+def unpicklableRing(self):
+    if self.treeBonds is not None:
+        raise TypeError("cannot pickle this worker")
+    return self.__dict__
+
+def test_createWorkersParallel_unpicklable(monkeypatch):
+    if "fork" not in mp.get_all_start_methods():
+        pytest.skip("needs the fork start method")
+    # the patched class has to reach the pool processes
+    monkeypatch.setattr(QEqBond, "__getstate__", unpicklableRing, raising=False)
+    monkeypatch.setattr(qcalc.optimize, "ProcessPoolExecutor", partial(ProcessPoolExecutor, mp_context=mp.get_context("fork")))
+    params, bondParams = parameters("QeqBond")
+    mols = [molecule(CHAIN), molecule(RING), molecule(CHAIN)]
+    workers, failures = createWorkersParallel(mols, params, "QeqBond", atomType, bondParams, nprocs=2, chunksize=3, maxOrder=2)
+    assert [k for k, _ in failures] == [1]
+    assert "cannot pickle" in failures[0][1]
+    assert workers[0] is not None and workers[1] is None and workers[2] is not None
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import numpy as np
+from qcalc.runs import OptimizationRun
+
+def rosenbrock(x):
+    return float(np.sum(100*(x[1:] - x[:-1]**2)**2 + (1 - x[:-1])**2))
+
+
+# a resumed differential evolution only evaluates the new generations, not the checkpointed population again
+def test_resume_keeps_population_energies(tmp_path):
+    bounds = [(-2, 2)] * 3
+    size = 5 * len(bounds)
+    with OptimizationRun(rosenbrock, bounds, str(tmp_path), nprocs=1, log=None) as run:
+        run.differentialEvolution(maxiter=3, seed=1, popsize=5)
+        first = len(run.evaluations.read()[1])
+    assert first == size * 4
+
+    with OptimizationRun(rosenbrock, bounds, str(tmp_path), nprocs=1, log=None) as run:
+        opt = run.differentialEvolution(maxiter=6, seed=1, popsize=5)
+        wallTimes, costs, X = run.evaluations.read()
+    assert opt.nit == 6
+    assert len(costs) - first == size * 3
+    assert opt.fun == np.min(costs)